@@ -0,0 +1,118 @@
+""" Compare the json codecs on the largest requests and responses, and
+encoding requests with and without the operation registry
+
+Usage: python benchmarks/codec.py [events]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from verisure import JsonCodec, OrjsonCodec, Session  # noqa: E402
+from verisure.operations import OperationRegistry  # noqa: E402
+
+
+def event_log_response(events):
+    """Event log response with a number of events"""
+    return {'data': {'installation': {'eventLog': {
+        'moreDataAvailable': True,
+        'pagedList': [{
+            'device': {
+                'deviceLabel': f'{index % 9999:04d} ABCD',
+                'area': 'Hallway',
+                'gui': {'label': 'Door', '__typename': 'GUI'},
+                '__typename': 'Device'},
+            'arloDevice': None,
+            'gatewayArea': None,
+            'eventType': 'FA',
+            'eventCategory': 'ARM',
+            'eventSource': 'USER',
+            'eventId': f'{index:020d}',
+            'eventTime': '2021-01-01T12:00:00.000Z',
+            'userName': 'Åsa Öberg',
+            'armState': 'ARMED_AWAY',
+            'userType': 'OWNER',
+            'climateValue': 21.5,
+            'sensorType': None,
+            'eventCount': 1,
+            '__typename': 'PagedEvent'} for index in range(events)],
+        '__typename': 'EventLog'}, '__typename': 'Installation'}}}
+
+
+def media_response(series):
+    """Cameras image series response with a number of series"""
+    return {'data': {'ContentProviderMediaSearch': {
+        'totalNumberOfMediaSeries': series,
+        'mediaSeriesList': [{
+            'seriesId': f'{index}',
+            'storageType': 'CLOUD',
+            'viewed': False,
+            'timestamp': '2021-01-01T12:00:00.000Z',
+            'deviceMediaList': [{
+                'contentUrl': f'https://media.example.com/{index}.jpg',
+                'mediaAvailable': True,
+                'deviceLabel': 'ABCD EFGH',
+                'mediaId': f'{index}',
+                'contentType': 'image/jpeg',
+                'timestamp': '2021-01-01T12:00:00.000Z',
+                'requestTimestamp': '2021-01-01T12:00:00.000Z',
+                'duration': None,
+                'expiryDate': '2021-02-01T12:00:00.000Z',
+                'viewed': False,
+                'thumbnailUrl': None,
+                'bitRate': None,
+                'width': 640,
+                'height': 480,
+                'codec': None}]} for index in range(series)]}}}
+
+
+def measure(codec, name, obj, number):
+    """Print the seconds per encode and decode of obj"""
+    content = codec.dumps(obj)
+    dumps = timeit.timeit(lambda: codec.dumps(obj), number=number) / number
+    loads = timeit.timeit(
+        lambda: codec.loads(content), number=number) / number
+    print(f'{codec.name:8} {name:24} {len(content):9} bytes  '
+          f'dumps {dumps * 1e6:9.1f} us  loads {loads * 1e6:9.1f} us')
+
+
+def measure_registry(codec, operations, number):
+    """Print the seconds per encoded request body, with and without registry"""
+    registry = OperationRegistry(codec)
+    for name, encode in [
+            ('dumps', lambda: codec.dumps(operations)),
+            ('registry', lambda: registry.encode(operations)),
+            ('persisted', lambda: registry.encode(operations, True))]:
+        seconds = timeit.timeit(encode, number=number) / number
+        print(f'{codec.name:8} {"request: " + name:24} {len(encode()):9} '
+              f'bytes  encode {seconds * 1e6:8.1f} us')
+
+
+def main():
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    session = Session('username', 'password')
+    session.set_giid('123456789')
+    cases = [
+        ('request: poll batch', [
+            session.arm_state(), session.climate(), session.door_window(),
+            session.smart_button(), session.smartplugs(),
+            session.cameras_image_series(), session.event_log()], 5000),
+        (f'response: {events} events', event_log_response(events), 50),
+        (f'response: {events} media', media_response(events), 50),
+    ]
+    codecs = [JsonCodec()]
+    try:
+        codecs.append(OrjsonCodec())
+    except ImportError:
+        print('orjson is not installed, only measuring the standard library')
+    for name, obj, number in cases:
+        for codec in codecs:
+            measure(codec, name, obj, number)
+    for codec in codecs:
+        measure_registry(codec, cases[0][1], 5000)
+
+
+if __name__ == '__main__':
+    main()
@@ -26,6 +26,8 @@ setup(
     install_requires=[
         'requests>=2.25.1',
         'click>=8.0.0a1'],
+    extras_require={
+        'async': ['aiohttp>=3.7']},
     packages=['verisure'],
     zip_safe=True,
     entry_points='''
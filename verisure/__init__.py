@@ -4,19 +4,50 @@ verisure app API.
 """
 
 __all__ = [
+    'async_capture_images',
+    'capture_images',
+    'AsyncBatcher',
+    'AsyncSession',
+    'AsyncWatcher',
+    'Batcher',
+    'Change',
+    'ClimateRecorder',
+    'CookieStore',
     'Error',
+    'EventStore',
+    'JsonCodec',
     'LoginError',
+    'MediaDownloader',
+    'OrjsonCodec',
+    'PollTimeoutError',
+    'RateLimitError',
+    'RateLimiter',
+    'ResponseCache',
     'ResponseError',
     'Session',
+    'Watcher',
 ]
 
 from .session import ( # NOQA
     Error,
     LoginError,
+    PollTimeoutError,
+    RateLimitError,
     VariableTypes,
     ResponseError,
     Session,
 )
+from .async_session import AsyncSession # NOQA
+from .batcher import AsyncBatcher, Batcher # NOQA
+from .cache import ResponseCache # NOQA
+from .camera import async_capture_images, capture_images # NOQA
+from .climate import ClimateRecorder # NOQA
+from .codec import JsonCodec, OrjsonCodec # NOQA
+from .cookies import CookieStore # NOQA
+from .event_store import EventStore # NOQA
+from .media import MediaDownloader # NOQA
+from .ratelimit import RateLimiter # NOQA
+from .watcher import AsyncWatcher, Change, Watcher # NOQA
 
 ALARM_ARMED_HOME = 'ARMED_HOME'
 ALARM_ARMED_AWAY = 'ARMED_AWAY'
@@ -1,11 +1,12 @@
 """ Command line interface for Verisure MyPages """
 
 import inspect
-import json
 import re
 import click
 import logging
 from verisure import VariableTypes, Session, ResponseError, LoginError
+from verisure.codec import CODECS
+from verisure.session import POLLED_MUTATIONS
 
 
 class DeviceLabel(click.ParamType):
@@ -106,15 +107,19 @@ def make_query(session, name, arguments):
 @click.option('-i', '--installation', 'installation', help='Installation number', type=int, default=0)  # noqa: E501
 @click.option('-c', '--cookie', 'cookie', help='File to store cookie in', default='~/.verisure-cookie')  # noqa: E501
 @click.option('--mfa', 'mfa', help='Login using MFA', default=False, is_flag=True)  # noqa: E501
+@click.option('--wait', 'wait', help='Wait for arm and lock state changes to complete', default=False, is_flag=True)  # noqa: E501
+@click.option('--codec', 'codec', help='Json codec', type=click.Choice(list(CODECS)), default='json')  # noqa: E501
 @click.option('--log-level', type=click.Choice(['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], case_sensitive=False))  # noqa: E501
 @options_from_operator_list()
-def cli(username, password, installation, cookie, mfa, log_level, **kwargs):
+def cli(username, password, installation, cookie, mfa, wait, codec,
+        log_level, **kwargs):
     """Read and change status of verisure devices through verisure app API"""
 
     if log_level:
         logging.basicConfig(level=logging.getLevelName(log_level))
 
-    session = Session(username, password, cookie)
+    codec = CODECS[codec]()
+    session = Session(username, password, cookie, codec=codec)
 
     try:
         # try using the cookie first
@@ -138,8 +143,18 @@ def cli(username, password, installation, cookie, mfa, log_level, **kwargs):
             make_query(session, name, arguments)
             for name, arguments in kwargs.items()
             if arguments]
+        if wait:
+            for query in queries:
+                if query.get('operationName') in POLLED_MUTATIONS:
+                    result = session.request_and_wait(query)
+                    click.echo(codec.dumps_pretty(result))
+            queries = [
+                query for query in queries
+                if query.get('operationName') not in POLLED_MUTATIONS]
+            if not queries:
+                return
         result = session.request(*queries)
-        click.echo(json.dumps(result, indent=4, separators=(',', ': ')))
+        click.echo(codec.dumps_pretty(result))
 
     except ResponseError as ex:
         click.echo(ex,err=True)
@@ -0,0 +1,878 @@
+'''
+Verisure session using asyncio, using verisure app api
+'''
+
+import asyncio
+import contextlib
+import inspect
+import logging
+import os
+import time
+
+import requests
+
+from .backoff import backoff_delays
+from .cache import is_mutation, operation_key
+from .selection import merge_installation, split_installation
+from .session import (
+    COOKIE_LIFETIME,
+    COOKIE_REFRESH_RETRY,
+    HEDGE_DELAY,
+    IMAGE_BUFFER_SIZE,
+    Error,
+    LoginError,
+    RATE_LIMIT_RETRIES,
+    PollTimeoutError,
+    RateLimitError,
+    RequestError,
+    ResponseError,
+    Session,
+)
+
+try:
+    import aiohttp
+except ImportError:  # pragma: no cover
+    aiohttp = None
+
+LOGGER = logging.getLogger(__package__)
+
+
+class AsyncSession(Session):
+    """ Verisure app session using non-blocking I/O
+
+    Shares the operations (`arm_state`, `climate`, ...) of `Session`, but
+    `login`, `request`, `download_image` and the other calls doing I/O are
+    coroutines. Requires aiohttp. Cookies, images and the endpoint health
+    are read and written in the default executor, to not block the event
+    loop.
+
+    Args:
+        username (str): Username used to login to verisure app
+        password (str): Password used to login to verisure app
+        cookie_file_name (str): path to cookie file
+        pool_connections (int): number of hosts to keep connections to
+        pool_maxsize (int): max number of connections per host
+        pool_block (bool): ignored, requests always wait for a free
+            connection when the limit is reached
+        cache (ResponseCache): cache for responses to read-only operations
+        coalesce (bool): share the response to identical read-only requests
+            already in flight instead of sending them again, the response
+            is then shared between callers and must not be modified
+        base_urls (list): api base urls to fail over between
+        persist_endpoints (bool): keep the health of the base urls in a file
+            next to the cookie file, so it survives restarts
+        timeout (float): max seconds to wait for each api call, or None
+        hedge (float): latency percentile (0-1) of the preferred base url
+            after which read-only requests are also sent to the next one,
+            the first usable response is used. None disables hedging
+        codec (JsonCodec): json codec for request and response bodies,
+            default is the standard library
+        persisted_queries (bool): send the hash of each graphql document
+            instead of the document, once the server has persisted it
+        rate_limiter (RateLimiter): limits the rate of api calls, share one
+            between the sessions of an account. Default only holds back
+            calls after the server throttled them
+        cookie_store (CookieStore): where to keep the cookies, default is
+            the cookie file
+
+    """
+
+    def _init_transport(self, pool_connections, pool_maxsize, pool_block):
+        if aiohttp is None:
+            raise Error("aiohttp is required for AsyncSession")
+        # The client session and lock must be created within the event loop
+        self._http = None
+        self._auth_lock = None
+        self._limit = pool_connections * pool_maxsize
+        self._limit_per_host = pool_maxsize
+        self._post = self._wrap_request('POST')
+        self._delete = self._wrap_request('DELETE')
+        self._get = self._wrap_request('GET')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def __enter__(self):
+        raise TypeError("Use 'async with' with AsyncSession")
+
+    def _client(self):
+        """Get the client session, create it on first use"""
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self._limit,
+                    limit_per_host=self._limit_per_host),
+                cookie_jar=aiohttp.DummyCookieJar())
+        return self._http
+
+    async def close(self):
+        """Stop cookie refresh and close all pooled connections"""
+        await self.stop_cookie_refresh()
+        await self._run_blocking(self._endpoints.save)
+        if self._http is not None:
+            await self._http.close()
+
+    def _wrap_request(self, method):
+        """
+        Used to create request coroutines to try the base urls, the
+        healthiest and fastest first, and track their health. The coroutines
+        return the response and its parsed json body. Calls throttled by every
+        base url are retried after the time the server asked for.
+        """
+
+        async def attempt(url, **kwargs):
+            last_exception = Error("Unknown error")
+            for base_url in self._base_urls():
+                response, data, last_exception = await self._send(
+                    method, base_url, url, **kwargs)
+                if last_exception is None:
+                    return response, data
+            raise last_exception
+
+        async def wrapper(url, **kwargs):
+            return await self._retry_throttled(attempt, url, **kwargs)
+        return wrapper
+
+    @staticmethod
+    async def _retry_throttled(attempt, *args, **kwargs):
+        """
+        Await attempt, and await it again while every base url throttles it.
+        The base urls then hold back the call for the time the server asked
+        for.
+        """
+        for retries in range(RATE_LIMIT_RETRIES, -1, -1):
+            try:
+                return await attempt(*args, **kwargs)
+            except RateLimitError:
+                if not retries:
+                    raise
+
+    async def _send(self, method, base_url, url, auth=None, timeout=None,
+                    **kwargs):
+        """
+        Send a request to one base url and track its health. Return the
+        response, its parsed json body and the error to fail over to the next
+        base url on.
+        """
+        if auth is not None:
+            kwargs['auth'] = aiohttp.BasicAuth(*auth)
+        timeout = timeout or self._timeout
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+        delay = self._rate_limiter.acquire(base_url)
+        if delay is None:
+            return None, None, RateLimitError(429, f"Throttled: {base_url}")
+        await asyncio.sleep(delay)
+        start = time.monotonic()
+        try:
+            async with self._client().request(
+                    method, base_url + url, **kwargs) as response:
+                content = await response.read()
+            data = self._parse_body(content)
+            try:
+                error = self._check_response(
+                    method, response.url, response.status, content, data)
+            except LoginError:
+                await self._success(base_url, start)
+                raise
+            if error is None:
+                await self._success(base_url, start)
+                return response, data, None
+            if isinstance(error, RateLimitError):
+                return self._throttled(
+                    base_url, error, response.headers.get('Retry-After'))
+        except aiohttp.ClientError as ex:
+            LOGGER.warning(f"Unexpected error on '{base_url}{url}' ({ex=})")
+            error = RequestError(str(ex))
+        except asyncio.TimeoutError:
+            LOGGER.warning(f"Timeout on '{base_url}{url}'")
+            error = RequestError(f"No response within {timeout}s")
+        await self._failure(base_url)
+        return None, None, error
+
+    @staticmethod
+    async def _run_blocking(function, *args):
+        """Call a function doing disk I/O in the default executor"""
+        return await asyncio.get_running_loop().run_in_executor(
+            None, function, *args)
+
+    async def _success(self, base_url, start):
+        """Track a response from a base url to a request sent at start"""
+        if self._endpoints.success(base_url, time.monotonic() - start):
+            await self._run_blocking(self._endpoints.save)
+
+    async def _failure(self, base_url):
+        """Track a failed request to a base url"""
+        if self._endpoints.failure(base_url):
+            await self._run_blocking(self._endpoints.save)
+
+    async def _hedged_post(self, url, **kwargs):
+        """
+        Post to the preferred base url, and also to the next one when there is
+        no answer within the hedge percentile of its latency or it fails.
+        Return the first usable response and its parsed json body. Calls
+        throttled by every base url are retried after the time the server
+        asked for.
+        """
+        return await self._retry_throttled(
+            self._hedged_attempt, url, **kwargs)
+
+    async def _hedged_attempt(self, url, **kwargs):
+        """Post once to the base urls for `_hedged_post`"""
+        base_urls = self._base_urls()
+        deadline = self._timeout and time.monotonic() + self._timeout
+        last_exception = Error("Unknown error")
+        pending = set()
+        hedge_time = time.monotonic()
+        try:
+            while True:
+                now = time.monotonic()
+                if base_urls and (not pending or now >= hedge_time):
+                    base_url = base_urls.pop(0)
+                    if pending:
+                        LOGGER.debug(f"Hedge request ({base_url=}, {url=})")
+                    pending.add(asyncio.ensure_future(self._send(
+                        'POST', base_url, url,
+                        timeout=deadline and deadline - now, **kwargs)))
+                    hedge_time = now + (self._endpoints.latency_percentile(
+                        base_url, self._hedge) or HEDGE_DELAY)
+                if not pending:
+                    raise last_exception
+                timeouts = [
+                    hedge_time - now if base_urls else None,
+                    deadline and deadline - now]
+                timeouts = [
+                    timeout for timeout in timeouts if timeout is not None]
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=max(min(timeouts), 0) if timeouts else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    response, data, last_exception = future.result()
+                    if last_exception is None:
+                        return response, data
+                if deadline and time.monotonic() >= deadline and pending:
+                    raise RequestError(f"No response within {self._timeout}s")
+        finally:
+            for future in pending:
+                future.cancel()
+
+    @staticmethod
+    def _response_cookies(response):
+        """Convert the cookies of a response to a cookie jar"""
+        cookie_jar = requests.sessions.RequestsCookieJar()
+        for morsel in response.cookies.values():
+            if not morsel['domain']:
+                morsel['domain'] = response.url.host
+            cookie_jar.set_cookie(requests.cookies.morsel_to_cookie(morsel))
+        return cookie_jar
+
+    async def _save_cookies(self):
+        """Store cookies in the cookie file, without blocking the event loop"""
+        self._cookie_time = time.monotonic()
+        await self._run_blocking(self._cookie_store.save, self._cookies)
+
+    async def _load_cookies(self):
+        """Load cookies from the cookie file, without blocking the event loop
+        """
+        try:
+            self._cookies = await self._run_blocking(self._cookie_store.load)
+        except Exception as ex:
+            raise LoginError("Failed to read cookie") from ex
+
+    async def _reload_cookies(self):
+        """
+        Use the cookies in the cookie file if another process has stored new
+        ones since they were last read or written. Return True if they were
+        reloaded.
+        """
+        if not await self._run_blocking(self._cookie_store.changed):
+            return False
+        try:
+            await self._load_cookies()
+        except LoginError as ex:
+            LOGGER.info(f"Failed to reload cookie ({ex=})")
+            return False
+        age = await self._run_blocking(self._cookie_store.age)
+        self._cookie_time = time.monotonic() - (age or 0)
+        LOGGER.info("Reloaded cookie stored by another process")
+        return True
+
+    async def _clear(self):
+        """Forget login state and remove the cookie file, without blocking the
+        event loop
+        """
+        self._base_url = None
+        self._giid = None
+        self._cookies = None
+        self._cookie_time = None
+        self._trust_token = None
+        await self._run_blocking(self._cookie_store.remove)
+
+    async def load_cookie(self):
+        """ Use the cookie in the cookie file without logging in, e.g. one
+        stored by another process sharing the account
+        Return True if a cookie younger than its lifetime was loaded
+        """
+        async with self._lock():
+            return await self._load_fresh_cookies()
+
+    async def _load_fresh_cookies(self):
+        """Load the stored cookies if they have not expired"""
+        age = await self._run_blocking(self._cookie_store.age)
+        if age is None or age >= COOKIE_LIFETIME:
+            return False
+        try:
+            await self._load_cookies()
+        except LoginError as ex:
+            LOGGER.info(f"Failed to load cookie ({ex=})")
+            return False
+        self._cookie_time = time.monotonic() - age
+        return True
+
+    async def _stored_login(self):
+        """ Reuse a stored cookie that has not expired
+        Return installations, or None if there is no usable cookie
+        """
+        if not await self._load_fresh_cookies():
+            return None
+        try:
+            installations = await self._request(
+                self.fetch_all_installations())
+        except LoginError as ex:
+            LOGGER.info(f"Stored cookie not accepted ({ex=})")
+            return None
+        if 'errors' in installations:
+            return None
+        LOGGER.info("Logged in using the stored cookie")
+        return installations
+
+    async def login(self):
+        """ Login to verisure app api
+        Login before calling any read or write commands. A cookie stored by
+        another process sharing the cookie file is reused while it lasts.
+        Return installations
+        """
+        async with self._lock(), self._cookie_store:
+            return await self._stored_login() or await self._login()
+
+    async def _login(self):
+        """Login using the password"""
+
+        response, data = await self._post(
+            "/auth/login",
+            headers={'APPLICATION_ID': 'PS_PYTHON'},
+            auth=(self._username, self._password))
+
+        if isinstance(data, dict) and "stepUpToken" in data:
+            raise LoginError("Multifactor authentication enabled, "
+                             "disable or create MFA cookie")
+
+        self._cookies = self._response_cookies(response)
+        await self._save_cookies()
+
+        installations = await self._request(self.fetch_all_installations())
+        if 'errors' not in installations:
+            return installations
+
+        raise LoginError("Failed to log in")
+
+    async def request_mfa(self):
+        """ Request MFA verification code """
+
+        response, data = await self._post(
+            url="/auth/login",
+            headers={'APPLICATION_ID': 'PS_PYTHON'},
+            auth=(self._username, self._password))
+
+        if not isinstance(data, dict) or "stepUpToken" not in data:
+            raise LoginError("Multifactor authentication disabled, "
+                             "use regular login instead")
+
+        self._cookies = self._response_cookies(response)
+        for mfa_type in ['phone', 'email']:
+            try:
+                mfa_response, _ = await self._post(
+                    url=f"/auth/mfa?type={mfa_type}",
+                    headers={'APPLICATION_ID': 'PS_PYTHON'},
+                    cookies=self._cookies)
+                if mfa_response.status == 200:
+                    return
+            except Exception as ex:
+                raise LoginError("Failed to request MFA type") from ex
+
+        raise LoginError("Failed to log in")
+
+    async def validate_mfa(self, code):
+        """ Validate mfa request
+        Return installations
+        """
+
+        response, _ = await self._post(
+            url="/auth/mfa/validate",
+            headers={
+                'APPLICATION_ID': 'PS_PYTHON',
+                'Accept': 'application/json',
+                'Content-Type': 'application/json'},
+            cookies=self._cookies,
+            data=self._codec.dumps({"token": code}))
+        self._cookies = self._response_cookies(response)
+
+        trust_response, trust_token = await self._post(
+            url="/auth/trust",
+            headers={
+                'APPLICATION_ID': 'PS_PYTHON',
+                'Accept': 'application/json',
+            },
+            cookies=self._cookies)
+        self._cookies.update(self._response_cookies(trust_response))
+        await self._save_cookies()
+        self._trust_token = trust_token
+
+        installations = await self._request(self.fetch_all_installations())
+        if 'errors' not in installations:
+            return installations
+
+        raise LoginError("Failed to log in")
+
+    async def login_cookie(self):
+        """ Login using cookie
+        A cookie stored by another process sharing the cookie file is reused
+        while it lasts.
+        Return installations
+        """
+        async with self._lock(), self._cookie_store:
+            return await self._stored_login() or await self._login_cookie()
+
+    async def _login_cookie(self):
+        """Login using the trust cookie in the cookie file"""
+
+        # Load cookie from file
+        await self._load_cookies()
+
+        # Login
+        response, _ = await self._post(
+            url="/auth/login",
+            headers={'APPLICATION_ID': 'PS_PYTHON'},
+            auth=(self._username, self._password),
+            cookies=self._trust_cookies())
+        self._cookies.update(self._response_cookies(response))
+        await self._save_cookies()
+
+        installations = await self._request(self.fetch_all_installations())
+        if 'errors' not in installations:
+            return installations
+
+        raise LoginError("Failed to log in")
+
+    async def update_cookie(self):
+        """ Update expired cookie
+        Cookie can last 15 minutes before it needs to be updated.
+        """
+
+        response, _ = await self._get(
+            url="/auth/token",
+            headers={'APPLICATION_ID': 'PS_PYTHON'},
+            cookies=self._refresh_cookies())
+
+        cookies = self._cookies.copy()
+        cookies.update(self._response_cookies(response))
+        self._cookies = cookies
+        await self._save_cookies()
+        LOGGER.debug(f"Saved cookies: {list(self._cookies.keys())}")
+
+    def start_cookie_refresh(self, margin=60):
+        """ Keep the cookie updated in a background task
+
+        Args:
+            margin (int): seconds before expiry to update the cookie
+        """
+        if self._refresher is not None:
+            return
+        self._refresher = asyncio.get_running_loop().create_task(
+            self._cookie_refresh_loop(margin))
+        LOGGER.info(f"Cookie refresh started ({margin=})")
+
+    async def stop_cookie_refresh(self):
+        """ Stop updating the cookie in the background """
+        if self._refresher is None:
+            return
+        task = self._refresher
+        self._refresher = None
+        task.cancel()
+        if task is not asyncio.current_task():
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _cookie_refresh_loop(self, margin):
+        """Update the cookie shortly before it expires until cancelled"""
+        while True:
+            delay = self._cookie_refresh_delay(margin)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            try:
+                async with self._lock(), self._cookie_store:
+                    # The session may have been renewed while waiting, here
+                    # or by another process sharing the cookie file
+                    await self._reload_cookies()
+                    if self._cookie_refresh_delay(margin) <= 0:
+                        await self.update_cookie()
+            except Error as ex:
+                LOGGER.warning(f"Failed to refresh cookie ({ex=})")
+                await asyncio.sleep(COOKIE_REFRESH_RETRY)
+
+    async def logout(self):
+        """ Log out from the verisure app api """
+        try:
+            if self._trust_token is not None:
+                token = self._trust_token['trustTokenValue']
+                await self._delete(
+                    url=f"/auth/trust/{token}",
+                    headers={
+                        'APPLICATION_ID': 'PS_PYTHON',
+                        'Accept': 'application/json',
+                    },
+                    cookies=self._cookies)
+            await self._delete(
+                url="/auth/logout",
+                headers={'APPLICATION_ID': 'PS_PYTHON'},
+                cookies=self._cookies)
+        finally:
+            await self._clear()
+
+    async def request(self, *operations):
+        """Request operations
+
+        An expired session is renewed once, shared by all tasks, and the
+        operations are then requested again.
+        """
+        if not operations:
+            # Return empty json if no operations were requested
+            return self._codec.loads(b"{}")
+        if self._cache is None:
+            return await self._coalescing_request(*operations)
+        responses, missing, generations = self._cache.split(operations)
+        if not missing:
+            return self._cache.merge(responses, [])
+        response = await self._coalescing_request(*missing)
+        requested = self._cache.update(missing, response, generations)
+        if requested is None:
+            return response
+        return self._cache.merge(responses, requested)
+
+    async def _coalescing_request(self, *operations):
+        """
+        Request operations, or wait for an identical request in flight. A
+        mutation detaches the reads in flight, so reads after it are sent
+        again instead of sharing an outdated response, and is passed to the
+        `on_mutation` callbacks.
+        """
+        if any(map(is_mutation, operations)):
+            self._in_flight.clear()
+            response = await self._renewing_request(*operations)
+            self._mutated(operations)
+            return response
+        if not self._coalesce:
+            return await self._renewing_request(*operations)
+        key = tuple(map(operation_key, operations))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._renewing_request(*operations))
+            self._in_flight[key] = task
+            task.add_done_callback(self._request_done)
+        else:
+            LOGGER.debug(f"Wait for identical request in flight ({key=})")
+        # A cancelled caller must not cancel the request for the others
+        return await asyncio.shield(task)
+
+    def _request_done(self, task):
+        """Stop sharing a finished request, unless a mutation detached it"""
+        for key, in_flight in list(self._in_flight.items()):
+            if in_flight is task:
+                del self._in_flight[key]
+
+    async def _renewing_request(self, *operations):
+        """Request operations, renew the session if it has expired"""
+        cookies = self._cookies
+        try:
+            return await self._request(*operations)
+        except LoginError:
+            if cookies is None:
+                raise
+            LOGGER.info("Request not authorized, renew session")
+            await self._reauthenticate(cookies)
+            return await self._request(*operations)
+
+    async def _request(self, *operations):
+        """Request operations without renewing the session"""
+        post = self._post if self._hedge is None \
+            or any(map(is_mutation, operations)) else self._hedged_post
+        data = await self._post_graphql(post, self._operations.encode(
+            operations, persisted=self._persisted_queries))
+        if self._persisted_queries:
+            missing = self._operations.not_persisted(data)
+            if missing:
+                LOGGER.debug(f"Register persisted queries ({missing=})")
+                data = self._operations.replace(
+                    data, missing, await self._post_graphql(
+                        post, self._operations.encode(
+                            [operations[index] for index in missing],
+                            register=True)))
+        return data
+
+    async def _post_graphql(self, post, body):
+        """Post an encoded request body, return the parsed response"""
+        response, data = await post(
+            '/graphql',
+            headers={
+                'APPLICATION_ID': 'PS_PYTHON',
+                'Accept': 'application/json'},
+            cookies=self._cookies,
+            data=body)
+        if data is None:
+            raise ResponseError(response.status, await response.text())
+        return data
+
+    def _lock(self):
+        """Get the lock serializing session renewal"""
+        if self._auth_lock is None:
+            self._auth_lock = asyncio.Lock()
+        return self._auth_lock
+
+    async def _reauthenticate(self, cookies):
+        """
+        Renew the session, unless another task has already renewed it since
+        a request was sent using `cookies`, or another process has stored a
+        new cookie. Update the cookie, or fall back to login using the cookie
+        file or the password.
+        """
+        async with self._lock(), self._cookie_store:
+            if self._cookies is not cookies \
+                    or await self._reload_cookies():
+                return
+            try:
+                await self.update_cookie()
+                return
+            except Error as ex:
+                LOGGER.info(f"Failed to update cookie ({ex=})")
+            try:
+                await self._login_cookie()
+                return
+            except Error as ex:
+                LOGGER.info(f"Failed to login using cookie ({ex=})")
+            await self._login()
+
+    async def get_installations(self):
+        """ Get information about installations """
+        return await self.request(self.fetch_all_installations())
+
+    async def request_installations(self, *builders, giids=None,
+                                    max_concurrency=8):
+        """ Request operations for several installations concurrently
+
+        Args:
+            builders: operations called with a giid keyword argument,
+                e.g. session.arm_state, session.climate
+            giids (list): installations to request, default is all
+            max_concurrency (int): max number of requests in parallel
+
+        Return a dict with the response, or the raised Error, per giid
+        """
+        if giids is None:
+            giids = self._installation_giids(await self.get_installations())
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def request(giid):
+            async with semaphore:
+                try:
+                    return await self.request(
+                        *[builder(giid=giid) for builder in builders])
+                except Error as ex:
+                    LOGGER.warning(f"Request failed ({giid=}, {ex=})")
+                    return ex
+
+        responses = await asyncio.gather(*[request(giid) for giid in giids])
+        return dict(zip(giids, responses))
+
+    async def request_snapshot(self, *operations):
+        """ Request operations on one installation as a single operation
+
+        Return a response per operation, like `request` for each operation
+        """
+        snapshot, plan = merge_installation(operations)
+        return split_installation(await self.request(snapshot), plan)
+
+    async def request_and_wait(self, operation, timeout=30,
+                               initial_delay=0.5, max_delay=5, jitter=0.2):
+        """ Request a mutation and wait until the state change completes
+
+        Polls the arm or lock state with exponential backoff.
+
+        Args:
+            operation (dict): arm_away, arm_home, disarm, door_lock or
+                door_unlock operation
+            timeout (float): seconds to wait in total
+            initial_delay (float): seconds to wait before the first poll
+            max_delay (float): max seconds between polls
+            jitter (float): random part of the delays, 0.2 is +-20%
+
+        Return the final poll result, with `result` and `createTime`
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        poll, field = self._poll_operation(
+            operation, await self.request(operation))
+        for delay in backoff_delays(initial_delay, max_delay, jitter=jitter):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise PollTimeoutError(
+                    f"{operation['operationName']} did not complete")
+            await asyncio.sleep(min(delay, remaining))
+            result = self._poll_result(await self.request(poll), field)
+            if result is not None:
+                return result
+
+    async def iter_event_log(self, giid=None, pagesize=50,
+                             event_categories=None, from_date=None,
+                             to_date=None, contact_ids=None,
+                             device_labels=None, prefetch=False):
+        """ Iterate over events in the event log, newest first
+
+        Pages are requested when needed, only one page (two when
+        prefetching) is kept in memory.
+
+        Args:
+            giid (str): Installation identifier, default is the set giid
+            pagesize (int): number of events to request at a time
+            event_categories (list): categories, default is all
+            from_date (str): only events after this date
+            to_date (str): only events before this date
+            contact_ids (list): only events from these contacts
+            device_labels (list): only events from these devices
+            prefetch (bool): request the next page while iterating
+        """
+        def page(offset):
+            return self.request(self.event_log(
+                giid, offset, pagesize, event_categories,
+                from_date, to_date, contact_ids, device_labels))
+
+        next_response = None
+        try:
+            offset = 0
+            response = await page(offset)
+            while True:
+                event_log = self._event_log_page(response)
+                more = event_log['moreDataAvailable']
+                if more and prefetch:
+                    next_response = asyncio.ensure_future(
+                        page(offset + pagesize))
+                for event in event_log['pagedList']:
+                    yield event
+                if not more:
+                    return
+                offset += pagesize
+                response = await (next_response or page(offset))
+                next_response = None
+        finally:
+            if next_response is not None:
+                next_response.cancel()
+
+    @contextlib.asynccontextmanager
+    async def open_image(self, image_url, timeout=30,
+                         buffer_size=IMAGE_BUFFER_SIZE):
+        """ Open an image url as a stream
+
+        Read the image without writing it to disk. Use as an async context
+        manager, the stream is an aiohttp StreamReader, e.g. `read` or
+        `iter_chunked` it. The connection is released on exit.
+
+        Args:
+            image_url (str): url to download from
+            timeout (float): seconds to wait for the server to respond
+            buffer_size (int): bytes to buffer
+        """
+        try:
+            async with self._client().get(
+                    image_url, read_bufsize=buffer_size,
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=timeout, sock_read=timeout)) as response:
+                if response.status >= 300:
+                    raise ResponseError(response.status, "Failed to get image")
+                yield response.content
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise RequestError("Failed to get image") from ex
+
+    async def stream_image(self, image_url, write, timeout=30,
+                           buffer_size=IMAGE_BUFFER_SIZE):
+        """ Stream an image to a callable or a writable object
+
+        Args:
+            image_url (str): url to download from
+            write: callable, coroutine function, or object with a write
+                method, taking chunks of bytes
+            timeout (float): seconds to wait for the server to respond
+            buffer_size (int): max bytes in a chunk
+
+        Return the size of the image
+        """
+        write = getattr(write, 'write', write)
+        total = 0
+        async with self.open_image(image_url, timeout, buffer_size) as stream:
+            async for chunk in stream.iter_chunked(buffer_size):
+                result = write(chunk)
+                if inspect.isawaitable(result):
+                    await result
+                total += len(chunk)
+        return total
+
+    async def download_image(self, image_url, file_name, timeout=30,
+                             chunk_size=65536, resume=False):
+        """ Download image from url
+
+        The image is written to `file_name`.part and moved to `file_name`
+        when complete. Files are written in the default executor, so the
+        event loop is not blocked by the disk.
+
+        Args:
+            image_url (str): url to download from
+            file_name (str): path to write the image to
+            timeout (float): seconds to wait for the server to respond
+            chunk_size (int): bytes to read and write at a time
+            resume (bool): continue a partial download using a range request
+        """
+        loop = asyncio.get_running_loop()
+        part_file_name = f'{file_name}.part'
+        offset = os.path.getsize(part_file_name) \
+            if resume and os.path.exists(part_file_name) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        try:
+            async with self._client().get(
+                    image_url, headers=headers,
+                    timeout=aiohttp.ClientTimeout(
+                        sock_connect=timeout, sock_read=timeout)) as response:
+                if response.status == 416 and offset:
+                    # Nothing left to download
+                    await loop.run_in_executor(
+                        None, os.replace, part_file_name, file_name)
+                    return
+                if response.status >= 300:
+                    raise ResponseError(response.status, "Failed to get image")
+                mode = 'ab' if response.status == 206 else 'wb'
+                image_file = await loop.run_in_executor(
+                    None, open, part_file_name, mode)
+                try:
+                    async for chunk in response.content.iter_chunked(
+                            chunk_size):
+                        await loop.run_in_executor(
+                            None, image_file.write, chunk)
+                finally:
+                    await loop.run_in_executor(None, image_file.close)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+            raise RequestError("Failed to get image") from ex
+        await loop.run_in_executor(None, os.replace, part_file_name, file_name)
@@ -0,0 +1,20 @@
+'''
+Delays for polling and retrying
+'''
+
+import random
+
+
+def backoff_delays(initial=0.5, maximum=5.0, factor=2.0, jitter=0.2):
+    """ Yield exponentially increasing delays, in seconds
+
+    Args:
+        initial (float): first delay
+        maximum (float): max delay, before jitter
+        factor (float): increase of each delay
+        jitter (float): random part of each delay, 0.2 is +-20%
+    """
+    delay = initial
+    while True:
+        yield delay * random.uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, maximum)
@@ -0,0 +1,205 @@
+'''
+Combine operations from many callers into batched requests
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+from .session import Error
+
+LOGGER = logging.getLogger(__package__)
+
+
+def _set_responses(batch, response):
+    """Pass each caller, that is still waiting, the response to its operation
+    """
+    responses = response if isinstance(response, list) else [response]
+    if len(responses) != len(batch):
+        error = Error("Response does not match the batched operations")
+        responses = None
+    for index, (_, future) in enumerate(batch):
+        if future.done():
+            continue
+        if responses is None:
+            future.set_exception(error)
+        else:
+            future.set_result(responses[index])
+
+
+class Batcher(object):
+    """ Send operations submitted by many threads in batched requests
+
+    Operations submitted within `window` seconds of the first one, up to
+    `max_batch_size`, are requested together in one POST.
+
+    Args:
+        session (Session): session used to request the operations
+        window (float): seconds to wait for more operations to a batch
+        max_batch_size (int): max number of operations in a batch
+        max_in_flight (int): max number of batches requested in parallel
+
+    """
+
+    def __init__(self, session, window=0.01, max_batch_size=20,
+                 max_in_flight=4):
+        self._session = session
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._closed = False
+        self._close_lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight,
+            thread_name_prefix='verisure-batch')
+        self._thread = threading.Thread(
+            target=self._collect, name='verisure-batcher', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, operation):
+        """ Add an operation to the next batch
+
+        Return a future with the response to the operation
+        """
+        future = concurrent.futures.Future()
+        with self._close_lock:
+            if self._closed:
+                raise Error("Batcher is closed")
+            self._queue.put((operation, future))
+        return future
+
+    def request(self, operation):
+        """ Request an operation in the next batch and wait for the response
+        """
+        return self.submit(operation).result()
+
+    def close(self):
+        """ Send the operations already submitted and stop """
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+        self._executor.shutdown()
+        # Nothing is submitted after closing, but never leave a caller hanging
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is not None and not item[1].done():
+                item[1].set_exception(Error("Batcher is closed"))
+
+    def _collect(self):
+        """Collect submitted operations to batches until closed"""
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_batch_size:
+                try:
+                    item = self._queue.get(
+                        timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._executor.submit(self._send, batch)
+                    return
+                batch.append(item)
+            self._executor.submit(self._send, batch)
+
+    def _send(self, batch):
+        """Request a batch and pass the responses to the callers"""
+        LOGGER.debug(f"Request batch ({len(batch)=})")
+        try:
+            response = self._session.request(
+                *[operation for operation, _ in batch])
+        except BaseException as ex:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        _set_responses(batch, response)
+
+
+class AsyncBatcher(object):
+    """ Send operations requested by many tasks in batched requests
+
+    Operations requested within `window` seconds of the first one, up to
+    `max_batch_size`, are requested together in one POST.
+
+    Args:
+        session (AsyncSession): session used to request the operations
+        window (float): seconds to wait for more operations to a batch
+        max_batch_size (int): max number of operations in a batch
+
+    """
+
+    def __init__(self, session, window=0.01, max_batch_size=20):
+        self._session = session
+        self._window = window
+        self._max_batch_size = max_batch_size
+        self._batch = []
+        self._timer = None
+        self._tasks = set()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def request(self, operation):
+        """ Request an operation in the next batch and wait for the response
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((operation, future))
+        if len(self._batch) >= self._max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._window, self._flush)
+        return await future
+
+    async def close(self):
+        """ Send the operations already requested and wait for them """
+        self._flush()
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+    def _flush(self):
+        """Start requesting the collected batch"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._batch:
+            return
+        batch, self._batch = self._batch, []
+        task = asyncio.ensure_future(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch):
+        """Request a batch and pass the responses to the callers"""
+        LOGGER.debug(f"Request batch ({len(batch)=})")
+        try:
+            response = await self._session.request(
+                *[operation for operation, _ in batch])
+        except Exception as ex:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(ex)
+            return
+        _set_responses(batch, response)
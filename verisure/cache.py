@@ -0,0 +1,187 @@
+'''
+Cache of responses to read-only operations
+'''
+
+import collections
+import json
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__package__)
+
+# Seconds to cache the response of an operation, per operationName
+DEFAULT_TTLS = {
+    'ArmState': 10,
+    'Capability': 3600,
+    'Climate': 60,
+    'DoorWindow': 10,
+    'Firmware': 3600,
+    'SmartLock': 10,
+    'SmartPlug': 10,
+}
+
+# Operations whose cached responses are outdated by a mutation
+INVALIDATED_BY = {
+    'armAway': ['ArmState'],
+    'armHome': ['ArmState'],
+    'disarm': ['ArmState'],
+    'DoorLock': ['SmartLock'],
+    'DoorUnlock': ['SmartLock'],
+    'DoorLockUpdateConfig': ['DoorLockConfiguration', 'SmartLock'],
+    'UpdateState': ['SmartPlug'],
+}
+
+
+def is_mutation(operation):
+    """Check if an operation changes state"""
+    return operation.get('query', '').lstrip().startswith('mutation')
+
+
+def _giid(operation):
+    return operation.get('variables', {}).get('giid')
+
+
+def operation_key(operation):
+    """Key identifying identical operations"""
+    return (
+        operation.get('operationName'),
+        json.dumps(operation.get('variables'), sort_keys=True),
+        operation.get('query'))
+
+
+class ResponseCache(object):
+    """ In-memory cache of responses to read-only operations
+
+    Responses are cached per operation name, variables and query. Cached
+    responses are shared between callers and must not be modified. A
+    response to a read that was in flight while a mutation invalidated the
+    installation is not cached.
+
+    Args:
+        ttls (dict): seconds to cache responses per operationName,
+            operations not listed are never cached
+        maxsize (int): max number of cached responses, the least recently
+            used response is evicted first
+
+    """
+
+    def __init__(self, ttls=None, maxsize=256):
+        self._ttls = DEFAULT_TTLS if ttls is None else ttls
+        self._maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        # Number of invalidations per giid
+        self._generations = collections.Counter()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, operation):
+        """Get a cached response, or None"""
+        if operation.get('operationName') not in self._ttls:
+            return None
+        key = operation_key(operation)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def generation(self, operation):
+        """Get the number of invalidations of the giid of an operation"""
+        with self._lock:
+            return self._generations[_giid(operation)]
+
+    def put(self, operation, response, generation=None):
+        """ Cache a response to an operation
+
+        Args:
+            operation (dict): the requested operation
+            response (dict): the response to the operation
+            generation (int): `generation` of the operation before it was
+                requested, the response is not cached if it changed since
+        """
+        ttl = self._ttls.get(operation.get('operationName'))
+        if ttl is None or 'errors' in response:
+            return
+        key = operation_key(operation)
+        giid = _giid(operation)
+        with self._lock:
+            if generation is not None \
+                    and generation != self._generations[giid]:
+                LOGGER.debug(f"Skip outdated response ({key[0]=}, {giid=})")
+                return
+            self._entries[key] = (time.monotonic() + ttl, response, giid)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, operation):
+        """Remove cached responses outdated by a mutation"""
+        names = INVALIDATED_BY.get(operation.get('operationName'))
+        if not names:
+            return
+        giid = _giid(operation)
+        with self._lock:
+            self._generations[giid] += 1
+            for key, entry in list(self._entries.items()):
+                if key[0] in names and entry[2] == giid:
+                    del self._entries[key]
+        LOGGER.debug(f"Invalidated cached responses ({names=}, {giid=})")
+
+    def clear(self):
+        """Remove all cached responses"""
+        with self._lock:
+            self._entries.clear()
+
+    def split(self, operations):
+        """
+        Look up operations, return a list with the cached response or None
+        per operation, the list of operations that must be requested and
+        their generations to pass to `update`
+        """
+        responses = [self.get(operation) for operation in operations]
+        missing = [
+            operation for operation, response in zip(operations, responses)
+            if response is None]
+        return responses, missing, [
+            self.generation(operation) for operation in missing]
+
+    def update(self, operations, response, generations=None):
+        """
+        Cache the response to requested operations and invalidate responses
+        outdated by mutations. Return the response as a list per operation,
+        or None if the response does not match the operations.
+        """
+        responses = response if isinstance(response, list) else [response]
+        if len(responses) != len(operations):
+            return None
+        if generations is None:
+            generations = [None] * len(operations)
+        for operation, operation_response, generation in zip(
+                operations, responses, generations):
+            if is_mutation(operation):
+                self.invalidate(operation)
+            else:
+                self.put(operation, operation_response, generation)
+        return responses
+
+    @staticmethod
+    def merge(responses, requested):
+        """
+        Fill the missing responses from `split` with the `update`d requested
+        responses, and return them shaped as a response to all operations
+        """
+        requested = iter(requested)
+        responses = [
+            next(requested) if response is None else response
+            for response in responses]
+        return responses if len(responses) > 1 else responses[0]
@@ -0,0 +1,225 @@
+'''
+Capture and download images from several cameras at once
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import time
+
+from .backoff import backoff_delays
+from .session import Error, PollTimeoutError, ResponseError
+
+LOGGER = logging.getLogger(__package__)
+
+# Capture request status when the image can be downloaded
+CAPTURE_AVAILABLE = 'AVAILABLE'
+
+
+class CaptureResult(object):
+    """ Result of capturing an image from one camera
+
+    Times are seconds since the capture started.
+
+    Attributes:
+        device_label (str): camera device label
+        file_name (str): path to the downloaded image
+        requested (float): time the capture was requested
+        ready (float): time the image was available
+        downloaded (float): time the image was downloaded
+        error (Error): error if the capture failed, otherwise None
+    """
+
+    def __init__(self, device_label, file_name):
+        self.device_label = device_label
+        self.file_name = file_name
+        self.request_id = None
+        self.requested = None
+        self.ready = None
+        self.downloaded = None
+        self.error = None
+
+    def __repr__(self):
+        return (
+            f"CaptureResult({self.device_label!r}, requested={self.requested}"
+            f", ready={self.ready}, downloaded={self.downloaded}"
+            f", error={self.error!r})")
+
+
+def _as_list(response):
+    return response if isinstance(response, list) else [response]
+
+
+def _set_request_ids(results, response, elapsed):
+    """Store the capture request ids, return the pending captures"""
+    pending = []
+    for result, capture in zip(results, _as_list(response)):
+        if 'errors' in capture:
+            result.error = ResponseError(200, capture['errors'])
+            continue
+        result.request_id = \
+            capture['data']['ContentProviderCaptureImageRequest']['requestId']
+        result.requested = elapsed
+        pending.append(result)
+    return pending
+
+
+def _set_statuses(pending, response, elapsed):
+    """Update pending captures, return the captures available now"""
+    available = []
+    for result, status in zip(list(pending), _as_list(response)):
+        if 'errors' in status:
+            result.error = ResponseError(200, status['errors'])
+            pending.remove(result)
+            continue
+        if status['data']['installation']['cameraContentProvider'][
+                'captureImageRequestStatus']['mediaRequestStatus'] \
+                == CAPTURE_AVAILABLE:
+            result.ready = elapsed
+            pending.remove(result)
+            available.append(result)
+    return available
+
+
+def _image_urls(response):
+    """Get the url of the latest image per device label"""
+    if 'errors' in response:
+        raise ResponseError(200, response['errors'])
+    images = response['data']['installation']['cameraContentProvider'][
+        'latestImage']
+    return {
+        image['deviceLabel']: image['contentUrl']
+        for image in _as_list(images)}
+
+
+def _downloads(available, response):
+    """Get the available captures with the url to download them from"""
+    try:
+        urls = _image_urls(response)
+    except ResponseError as ex:
+        urls = {}
+        for result in available:
+            result.error = ex
+    for result in available:
+        if result.device_label in urls:
+            yield result, urls[result.device_label]
+        elif result.error is None:
+            result.error = Error("No image from camera")
+
+
+def _capture_results(device_labels, directory):
+    return [
+        CaptureResult(
+            device_label,
+            os.path.join(directory, f"{device_label.replace(' ', '_')}.jpg"))
+        for device_label in device_labels]
+
+
+def capture_images(session, device_labels, directory, giid=None, timeout=60,
+                   initial_delay=1, max_delay=5, max_downloads=4):
+    """ Capture and download new images from several cameras
+
+    Captures are requested together, their statuses are polled together
+    and each image is downloaded as soon as it is available.
+
+    Args:
+        session (Session): logged in session
+        device_labels (list): device labels of the cameras
+        directory (str): directory to download images to
+        giid (str): Installation identifier, default is the set giid
+        timeout (float): seconds to wait for the images
+        initial_delay (float): seconds to wait before the first poll
+        max_delay (float): max seconds between polls
+        max_downloads (int): max number of images downloaded in parallel
+
+    Return a CaptureResult per device label
+    """
+    start = time.monotonic()
+    results = _capture_results(device_labels, directory)
+    pending = _set_request_ids(results, session.request(*[
+        session.camera_get_request_id(result.device_label, giid)
+        for result in results]), time.monotonic() - start)
+
+    def download(result, url):
+        try:
+            session.download_image(url, result.file_name)
+            result.downloaded = time.monotonic() - start
+        except Error as ex:
+            result.error = ex
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_downloads) as executor:
+        for delay in backoff_delays(initial_delay, max_delay):
+            remaining = timeout - (time.monotonic() - start)
+            if not pending or remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            available = _set_statuses(pending, session.request(*[
+                session.camera_capture(
+                    result.device_label, result.request_id, giid)
+                for result in pending]), time.monotonic() - start)
+            if not available:
+                continue
+            for result, url in _downloads(available, session.request(
+                    session.cameras_last_image(giid))):
+                executor.submit(download, result, url)
+    for result in pending:
+        result.error = PollTimeoutError("Image was not captured in time")
+    LOGGER.debug(f"Captured images ({results=})")
+    return results
+
+
+async def async_capture_images(session, device_labels, directory, giid=None,
+                               timeout=60, initial_delay=1, max_delay=5):
+    """ Capture and download new images from several cameras
+
+    Captures are requested together, their statuses are polled together
+    and each image is downloaded as soon as it is available.
+
+    Args:
+        session (AsyncSession): logged in session
+        device_labels (list): device labels of the cameras
+        directory (str): directory to download images to
+        giid (str): Installation identifier, default is the set giid
+        timeout (float): seconds to wait for the images
+        initial_delay (float): seconds to wait before the first poll
+        max_delay (float): max seconds between polls
+
+    Return a CaptureResult per device label
+    """
+    start = time.monotonic()
+    results = _capture_results(device_labels, directory)
+    pending = _set_request_ids(results, await session.request(*[
+        session.camera_get_request_id(result.device_label, giid)
+        for result in results]), time.monotonic() - start)
+
+    async def download(result, url):
+        try:
+            await session.download_image(url, result.file_name)
+            result.downloaded = time.monotonic() - start
+        except Error as ex:
+            result.error = ex
+
+    downloads = []
+    for delay in backoff_delays(initial_delay, max_delay):
+        remaining = timeout - (time.monotonic() - start)
+        if not pending or remaining <= 0:
+            break
+        await asyncio.sleep(min(delay, remaining))
+        available = _set_statuses(pending, await session.request(*[
+            session.camera_capture(
+                result.device_label, result.request_id, giid)
+            for result in pending]), time.monotonic() - start)
+        if not available:
+            continue
+        downloads.extend(
+            asyncio.ensure_future(download(result, url))
+            for result, url in _downloads(available, await session.request(
+                session.cameras_last_image(giid))))
+    if downloads:
+        await asyncio.wait(downloads)
+    for result in pending:
+        result.error = PollTimeoutError("Image was not captured in time")
+    LOGGER.debug(f"Captured images ({results=})")
+    return results
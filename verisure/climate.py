@@ -0,0 +1,233 @@
+'''
+Compact history of climate readings
+'''
+
+import array
+import bisect
+import datetime
+import logging
+import mmap
+import os
+import struct
+
+from .session import ResponseError
+
+LOGGER = logging.getLogger(__package__)
+
+SENSORS = ('temperature', 'humidity')
+
+_MAGIC = b'VSCLIMA1'
+_COUNT = struct.Struct('<I')
+_HEADER = struct.Struct('<HQ')
+
+
+def parse_timestamp(timestamp):
+    """Convert a timestamp from the api to seconds since epoch"""
+    return datetime.datetime.strptime(
+        timestamp, '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+            tzinfo=datetime.timezone.utc).timestamp()
+
+
+class ClimateSeries(object):
+    """ Readings of one sensor, as arrays of timestamps and values
+
+    Timestamps are seconds since epoch in increasing order.
+    """
+
+    def __init__(self, timestamps=None, values=None):
+        self._timestamps = array.array('d') if timestamps is None \
+            else timestamps
+        self._values = array.array('d') if values is None else values
+
+    def __len__(self):
+        return len(self._timestamps)
+
+    @property
+    def timestamps(self):
+        """Timestamps of all readings"""
+        return self._timestamps
+
+    @property
+    def values(self):
+        """Values of all readings"""
+        return self._values
+
+    def append(self, timestamp, value):
+        """ Add a reading, return False if it is not newer than the last """
+        if self._timestamps and timestamp <= self._timestamps[-1]:
+            return False
+        if not isinstance(self._timestamps, array.array):
+            # Copy readings loaded from a mapped file before changing them
+            self._timestamps = array.array('d', self._timestamps)
+            self._values = array.array('d', self._values)
+        self._timestamps.append(timestamp)
+        self._values.append(value)
+        return True
+
+    def _slice(self, start, end):
+        first = 0 if start is None \
+            else bisect.bisect_left(self._timestamps, start)
+        last = len(self._timestamps) if end is None \
+            else bisect.bisect_left(self._timestamps, end)
+        return first, last
+
+    def range(self, start=None, end=None):
+        """ Get timestamps and values of readings from start until end """
+        first, last = self._slice(start, end)
+        return self._timestamps[first:last], self._values[first:last]
+
+    def stats(self, start=None, end=None):
+        """ Get min, max, mean and count of readings from start until end,
+        or None if there are no readings
+        """
+        return self._stats(*self._slice(start, end))
+
+    def _stats(self, first, last):
+        if first == last:
+            return None
+        values = self._values[first:last]
+        return {
+            'min': min(values),
+            'max': max(values),
+            'mean': sum(values) / len(values),
+            'count': len(values),
+        }
+
+    def downsample(self, interval, start=None, end=None):
+        """ Get stats per interval (seconds) of readings from start until end
+
+        Return a list of (interval start, stats) for intervals with readings
+        """
+        first, last = self._slice(start, end)
+        buckets = []
+        while first < last:
+            bucket = self._timestamps[first] - \
+                self._timestamps[first] % interval
+            bucket_end = bisect.bisect_left(
+                self._timestamps, bucket + interval, first, last)
+            buckets.append((bucket, self._stats(first, bucket_end)))
+            first = bucket_end
+        return buckets
+
+
+class ClimateRecorder(object):
+    """ Record climate readings per device label and sensor
+
+    Args:
+        session (Session): logged in session
+        file_name (str): file to load readings from and save them to
+
+    The file stores the readings as raw arrays of native doubles, it is
+    memory mapped when loaded and readings are only copied when new ones
+    are added.
+    """
+
+    def __init__(self, session, file_name=None):
+        self._session = session
+        self._file_name = file_name and os.path.expanduser(file_name)
+        self._series = {}
+        self._mmap = None
+        if self._file_name and os.path.exists(self._file_name):
+            self.load(self._file_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Release the mapped file"""
+        if self._mmap is not None:
+            self._series = {
+                key: ClimateSeries(
+                    array.array('d', series.timestamps),
+                    array.array('d', series.values))
+                for key, series in self._series.items()}
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Readings are still referenced, unmapped when released
+                pass
+            self._mmap = None
+
+    def series(self, device_label, sensor='temperature'):
+        """Get the readings of a sensor"""
+        return self._series.setdefault(
+            (device_label, sensor), ClimateSeries())
+
+    def device_labels(self):
+        """Get the device labels with readings"""
+        return sorted({device_label for device_label, _ in self._series})
+
+    def record(self, giid=None):
+        """ Request climate and add new readings
+
+        Return the number of new readings
+        """
+        response = self._session.request(self._session.climate(giid))
+        if 'errors' in response:
+            raise ResponseError(200, response['errors'])
+        added = 0
+        for climate in response['data']['installation']['climates']:
+            device_label = climate['device']['deviceLabel']
+            for sensor in SENSORS:
+                timestamp = climate.get(f'{sensor}Timestamp')
+                value = climate.get(f'{sensor}Value')
+                if timestamp is None or value is None:
+                    continue
+                added += self.series(device_label, sensor).append(
+                    parse_timestamp(timestamp), value)
+        LOGGER.debug(f"Recorded climate ({added=})")
+        return added
+
+    def save(self, file_name=None):
+        """ Write all readings to a file, replacing it atomically, default
+        is the file of the recorder
+        """
+        file_name = file_name or self._file_name
+        if not file_name:
+            raise ValueError("No file to save climate readings to")
+        file_name = os.path.expanduser(file_name)
+        temp_file_name = f'{file_name}.tmp'
+        with open(temp_file_name, 'wb') as climate_file:
+            climate_file.write(_MAGIC)
+            climate_file.write(_COUNT.pack(len(self._series)))
+            for (device_label, sensor), series in self._series.items():
+                key = f'{device_label}\0{sensor}'.encode()
+                climate_file.write(_HEADER.pack(len(key), len(series)))
+                climate_file.write(key)
+                # Align the arrays to 8 bytes
+                climate_file.write(b'\0' * (-climate_file.tell() % 8))
+                climate_file.write(memoryview(series.timestamps).cast('B'))
+                climate_file.write(memoryview(series.values).cast('B'))
+        os.replace(temp_file_name, file_name)
+
+    def load(self, file_name):
+        """ Map readings from a file, replacing the current readings """
+        self.close()
+        with open(os.path.expanduser(file_name), 'rb') as climate_file:
+            data = mmap.mmap(
+                climate_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if data[:len(_MAGIC)] != _MAGIC:
+            data.close()
+            raise ValueError(f"Not a climate file: {file_name}")
+        view = memoryview(data)
+        offset = len(_MAGIC)
+        (count,) = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        series = {}
+        for _ in range(count):
+            key_length, length = _HEADER.unpack_from(data, offset)
+            offset += _HEADER.size
+            device_label, sensor = bytes(
+                view[offset:offset + key_length]).decode().split('\0')
+            offset += key_length
+            offset += -offset % 8
+            size = length * 8
+            series[(device_label, sensor)] = ClimateSeries(
+                view[offset:offset + size].cast('d'),
+                view[offset + size:offset + 2 * size].cast('d'))
+            offset += 2 * size
+        self._series = series
+        self._mmap = data
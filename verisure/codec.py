@@ -0,0 +1,67 @@
+'''
+Json encoding and decoding of request and response bodies
+'''
+
+import json
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+class JsonCodec(object):
+    """ Json codec using the standard library
+
+    Bodies are encoded to compact utf-8 bytes and decoded from bytes.
+    """
+
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj):
+        """Encode to json bytes"""
+        return _ENCODER.encode(obj).encode()
+
+    @staticmethod
+    def loads(content):
+        """Decode json bytes or str"""
+        return json.loads(content)
+
+    @staticmethod
+    def dumps_pretty(obj):
+        """Encode to indented json text, for people to read"""
+        return json.dumps(obj, indent=4, separators=(',', ': '))
+
+
+class OrjsonCodec(JsonCodec):
+    """ Json codec using orjson, which works directly on bytes
+
+    Requires orjson.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            raise ImportError("orjson is required for OrjsonCodec")
+
+    @staticmethod
+    def dumps(obj):
+        """Encode to json bytes"""
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(content):
+        """Decode json bytes or str"""
+        return orjson.loads(content)
+
+    @staticmethod
+    def dumps_pretty(obj):
+        """Encode to indented json text, for people to read"""
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec, OrjsonCodec)}
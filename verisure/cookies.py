@@ -0,0 +1,151 @@
+'''
+Cookie file shared between processes
+'''
+
+import asyncio
+import logging
+import os
+import pickle
+import time
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+LOGGER = logging.getLogger(__package__)
+
+# Seconds between attempts to take the lock without blocking the event loop
+LOCK_POLL_INTERVAL = 0.05
+
+
+class CookieStore(object):
+    """ Store the session cookies in a file shared between processes
+
+    Writes are atomic, so a process never reads a partly written file, and
+    are skipped when the cookies did not change. The file is only read
+    again after another process changed it. Hold the lock (use the store as
+    a context manager) while renewing the session, so processes sharing an
+    account renew it once and the others reuse the stored cookies. Without
+    fcntl, e.g. on Windows, the lock does not serialize processes.
+
+    Args:
+        file_name (str): path to cookie file
+
+    """
+
+    def __init__(self, file_name):
+        self._file_name = file_name
+        self._lock_file_name = f'{file_name}.lock'
+        self._lock_file = None
+        # Pickled cookies and stat of the file, as last read or written
+        self._content = None
+        self._stat = None
+
+    @staticmethod
+    def _signature(stat):
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def _file_signature(self):
+        try:
+            return self._signature(os.stat(self._file_name))
+        except OSError:
+            return None
+
+    def changed(self):
+        """ Check if the file changed since it was last read or written by
+        this store
+        """
+        return self._file_signature() != self._stat
+
+    def age(self):
+        """ Seconds since the cookies were stored, None without a file """
+        try:
+            return max(time.time() - os.stat(self._file_name).st_mtime, 0)
+        except OSError:
+            return None
+
+    def load(self):
+        """ Read the cookies from the file """
+        with open(self._file_name, 'rb') as cookie_file:
+            content = cookie_file.read()
+            stat = os.fstat(cookie_file.fileno())
+        cookies = pickle.loads(content)
+        self._content = content
+        self._stat = self._signature(stat)
+        return cookies
+
+    def save(self, cookies):
+        """ Write the cookies to the file, unless they are already stored
+
+        Return True if the file was written
+        """
+        content = pickle.dumps(cookies)
+        if content == self._content and not self.changed():
+            LOGGER.debug("Cookies unchanged, skip write")
+            return False
+        temp_file_name = f'{self._file_name}.{os.getpid()}.tmp'
+        descriptor = os.open(
+            temp_file_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with open(descriptor, 'wb') as cookie_file:
+                cookie_file.write(content)
+                cookie_file.flush()
+                os.fsync(cookie_file.fileno())
+                # Renaming keeps the inode and modification time
+                stat = os.fstat(cookie_file.fileno())
+            os.replace(temp_file_name, self._file_name)
+        except BaseException:
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            raise
+        self._content = content
+        self._stat = self._signature(stat)
+        return True
+
+    def remove(self):
+        """ Remove the file """
+        self._content = None
+        self._stat = None
+        if os.path.exists(self._file_name):
+            os.remove(self._file_name)
+
+    def lock(self, blocking=True):
+        """ Take the lock shared with other processes
+
+        Return False if it is held elsewhere and blocking is False
+        """
+        lock_file = open(self._lock_file_name, 'a')
+        if fcntl is not None:
+            flags = fcntl.LOCK_EX if blocking \
+                else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file.fileno(), flags)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+        self._lock_file = lock_file
+        return True
+
+    def unlock(self):
+        """ Release the lock """
+        lock_file = self._lock_file
+        self._lock_file = None
+        if lock_file is not None:
+            # Closing the file releases the lock
+            lock_file.close()
+
+    def __enter__(self):
+        self.lock()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.unlock()
+
+    async def __aenter__(self):
+        while not self.lock(blocking=False):
+            await asyncio.sleep(LOCK_POLL_INTERVAL)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.unlock()
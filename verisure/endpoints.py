@@ -0,0 +1,182 @@
+'''
+Health of the api base urls
+'''
+
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+LOGGER = logging.getLogger(__package__)
+
+BASE_URLS = ['https://automation01.verisure.com',
+             'https://automation02.verisure.com']
+
+
+class _Endpoint(object):
+    """Health of one base url"""
+
+    def __init__(self, url, window):
+        self.url = url
+        self.latency = None
+        self.latencies = collections.deque(maxlen=window)
+        self.results = collections.deque(maxlen=window)
+        self.open_until = None
+
+    def error_rate(self):
+        if not self.results:
+            return 0
+        return self.results.count(False) / len(self.results)
+
+
+class Endpoints(object):
+    """ Track health of the base urls and order them by preference
+
+    A base url is taken out of rotation (the circuit is opened) for
+    `cooldown` seconds when at least `error_threshold` of its last `window`
+    requests failed. After the cooldown the next request tries it first
+    (half-open), a success puts it back in rotation with a clean record and
+    a failure opens the circuit again. Base urls in rotation are ordered by
+    their recent error rate and average latency.
+
+    Args:
+        urls (list): base urls, in initial order of preference
+        window (int): number of recent requests to track per base url
+        min_requests (int): requests needed before the circuit can open
+        error_threshold (float): part of failed requests opening the circuit
+        cooldown (float): seconds to keep the circuit open
+        file_name (str): file to persist the health in, or None
+
+    """
+
+    def __init__(self, urls=None, window=20, min_requests=3,
+                 error_threshold=0.5, cooldown=60, file_name=None):
+        self._window = window
+        self._min_requests = min_requests
+        self._error_threshold = error_threshold
+        self._cooldown = cooldown
+        self._file_name = file_name and os.path.expanduser(file_name)
+        self._endpoints = [
+            _Endpoint(url, window) for url in (urls or BASE_URLS)]
+        self._lock = threading.Lock()
+        if self._file_name:
+            self._load()
+
+    def ordered(self):
+        """ Get the base urls to try, in order of preference
+
+        Base urls with an open circuit are last, so a request is still
+        tried when all of them are unhealthy. A base url whose cooldown has
+        passed is first, to probe it with this request. Other requests keep
+        avoiding it for another cooldown, until the probe succeeds.
+        """
+        now = time.monotonic()
+        with self._lock:
+            probe = None
+            for endpoint in self._endpoints:
+                if endpoint.open_until is not None \
+                        and endpoint.open_until <= now:
+                    endpoint.open_until = now + self._cooldown
+                    probe = endpoint
+                    LOGGER.info(f"Circuit half-open ({endpoint.url=})")
+                    break
+            # Unmeasured base urls before measured ones with the same error
+            # rate, to get their latency
+            return [endpoint.url for endpoint in sorted(
+                self._endpoints,
+                key=lambda endpoint: (
+                    endpoint is not probe,
+                    endpoint.open_until is not None
+                    and endpoint.open_until > now,
+                    endpoint.error_rate(),
+                    endpoint.latency or 0))]
+
+    def success(self, url, latency):
+        """ Record a response from a base url, with its latency in seconds
+
+        Return True if its circuit closed, the health should then be saved
+        """
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint.latency = latency if endpoint.latency is None \
+                else 0.8 * endpoint.latency + 0.2 * latency
+            endpoint.latencies.append(latency)
+            endpoint.results.append(True)
+            closed = endpoint.open_until is not None
+            if closed:
+                endpoint.open_until = None
+                endpoint.results.clear()
+                LOGGER.info(f"Circuit closed ({url=})")
+        return closed
+
+    def failure(self, url):
+        """ Record a failed request to a base url
+
+        Return True if its circuit opened, the health should then be saved
+        """
+        with self._lock:
+            endpoint = self._endpoint(url)
+            endpoint.results.append(False)
+            opened = endpoint.open_until is not None or (
+                len(endpoint.results) >= self._min_requests
+                and endpoint.error_rate() >= self._error_threshold)
+            if opened:
+                endpoint.open_until = time.monotonic() + self._cooldown
+                LOGGER.warning(f"Circuit opened ({url=})")
+        return opened
+
+    def latency_percentile(self, url, percentile):
+        """ Get a percentile (0-1) of the recent latencies of a base url,
+        or None if it has no recent responses
+        """
+        with self._lock:
+            latencies = sorted(self._endpoint(url).latencies)
+        if not latencies:
+            return None
+        return latencies[min(
+            int(percentile * len(latencies)), len(latencies) - 1)]
+
+    def _endpoint(self, url):
+        for endpoint in self._endpoints:
+            if endpoint.url == url:
+                return endpoint
+        raise ValueError(f"Unknown base url: {url}")
+
+    def save(self):
+        """ Persist the health to the file, if any """
+        if not self._file_name:
+            return
+        offset = time.time() - time.monotonic()
+        with self._lock:
+            state = {
+                endpoint.url: {
+                    'latency': endpoint.latency,
+                    'results': list(endpoint.results),
+                    'open_until': (
+                        endpoint.open_until and endpoint.open_until + offset),
+                } for endpoint in self._endpoints}
+        temp_file_name = f'{self._file_name}.{os.getpid()}.tmp'
+        try:
+            with open(temp_file_name, 'w') as endpoints_file:
+                json.dump(state, endpoints_file)
+            os.replace(temp_file_name, self._file_name)
+        except OSError as ex:
+            LOGGER.warning(f"Failed to save endpoint health ({ex=})")
+
+    def _load(self):
+        try:
+            with open(self._file_name) as endpoints_file:
+                state = json.load(endpoints_file)
+        except (OSError, ValueError):
+            return
+        offset = time.time() - time.monotonic()
+        for endpoint in self._endpoints:
+            saved = state.get(endpoint.url)
+            if not saved:
+                continue
+            endpoint.latency = saved['latency']
+            endpoint.results.extend(saved['results'])
+            if saved['open_until'] and saved['open_until'] > time.time():
+                endpoint.open_until = saved['open_until'] - offset
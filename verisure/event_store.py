@@ -0,0 +1,109 @@
+'''
+Local store of events from the event log
+'''
+
+import json
+import logging
+import os
+import sqlite3
+
+LOGGER = logging.getLogger(__package__)
+
+
+class EventStore(object):
+    """ Local SQLite store of events from the event log
+
+    Events are stored per installation, keyed by eventId. Each `sync` only
+    requests pages until it reaches events already in the store.
+
+    Args:
+        file_name (str): path to the database file
+
+    """
+
+    def __init__(self, file_name='~/.verisure-events.sqlite'):
+        self._db = sqlite3.connect(
+            os.path.expanduser(file_name), check_same_thread=False)
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "giid TEXT NOT NULL, "
+                "event_id TEXT NOT NULL, "
+                "event_time TEXT NOT NULL, "
+                "event TEXT NOT NULL, "
+                "PRIMARY KEY (giid, event_id))")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS events_time "
+                "ON events (giid, event_time)")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Close the database"""
+        self._db.close()
+
+    def newest_event_time(self, giid):
+        """Get the time of the newest stored event, or None"""
+        row = self._db.execute(
+            "SELECT MAX(event_time) FROM events WHERE giid = ?",
+            (giid,)).fetchone()
+        return row[0]
+
+    def _is_stored(self, giid, event_id):
+        return self._db.execute(
+            "SELECT 1 FROM events WHERE giid = ? AND event_id = ?",
+            (giid, event_id)).fetchone() is not None
+
+    def sync(self, session, giid=None, pagesize=50):
+        """ Store events newer than the stored ones
+
+        Args:
+            session (Session): logged in session
+            giid (str): Installation identifier, default is the set giid
+            pagesize (int): number of events to request at a time
+
+        Return the number of stored events
+        """
+        giid = giid or session.giid
+        newest = self.newest_event_time(giid)
+        new_events = []
+        events = session.iter_event_log(giid, pagesize=pagesize)
+        try:
+            for event in events:
+                if newest is not None and event['eventTime'] < newest:
+                    break
+                if newest is not None and event['eventTime'] == newest \
+                        and self._is_stored(giid, event['eventId']):
+                    continue
+                new_events.append(event)
+        finally:
+            events.close()
+        # All or nothing, the newest event time must not skip older events
+        with self._db:
+            self._db.executemany(
+                "INSERT OR IGNORE INTO events VALUES (?, ?, ?, ?)",
+                [(giid, event['eventId'], event['eventTime'],
+                  json.dumps(event)) for event in new_events])
+        LOGGER.info(f"Synced event log ({giid=}, {len(new_events)=})")
+        return len(new_events)
+
+    def events(self, giid, from_time=None, to_time=None):
+        """ Iterate over stored events, newest first
+
+        Args:
+            giid (str): Installation identifier
+            from_time (str): only events at or after this eventTime
+            to_time (str): only events before this eventTime
+        """
+        cursor = self._db.execute(
+            "SELECT event FROM events WHERE giid = ? "
+            "AND event_time >= COALESCE(?, '') "
+            "AND (? IS NULL OR event_time < ?) "
+            "ORDER BY event_time DESC",
+            (giid, from_time, to_time, to_time))
+        for row in cursor:
+            yield json.loads(row[0])
@@ -0,0 +1,143 @@
+'''
+Download media from the cameras image series
+'''
+
+import concurrent.futures
+import json
+import logging
+import mimetypes
+import os
+import re
+import threading
+
+from .session import Error, ResponseError
+
+LOGGER = logging.getLogger(__package__)
+
+INDEX_FILE_NAME = '.verisure-media.json'
+
+
+class MediaDownloader(object):
+    """ Download media from the cameras image series to a directory
+
+    Downloaded media are recorded in an index in the directory, so every
+    run only downloads new media. Media already on disk are not downloaded
+    again either. Interrupted downloads are resumed.
+
+    Args:
+        session (Session): logged in session
+        directory (str): directory to download media to
+        max_workers (int): max number of parallel downloads, keep it below
+            the pool_maxsize of the session to reuse connections
+        pagesize (int): number of media series to request at a time
+
+    """
+
+    def __init__(self, session, directory, max_workers=4, pagesize=50):
+        self._session = session
+        self._directory = os.path.expanduser(directory)
+        self._max_workers = max_workers
+        self._pagesize = pagesize
+        self._index_file_name = os.path.join(
+            self._directory, INDEX_FILE_NAME)
+        self._lock = threading.Lock()
+        os.makedirs(self._directory, exist_ok=True)
+        self._index = self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(self._index_file_name) as index_file:
+                return json.load(index_file)
+        except FileNotFoundError:
+            return {}
+
+    def _save_index(self):
+        temp_file_name = f'{self._index_file_name}.tmp'
+        with self._lock:
+            with open(temp_file_name, 'w') as index_file:
+                json.dump(self._index, index_file)
+            os.replace(temp_file_name, self._index_file_name)
+
+    def _is_downloaded(self, media):
+        """
+        Check if a media is in the index or on disk. Completed downloads are
+        on disk before they are indexed, in case the run was interrupted.
+        """
+        file_name = self._index.get(media['mediaId'])
+        if file_name is not None and os.path.exists(
+                os.path.join(self._directory, file_name)):
+            return True
+        file_name = self._file_name(media)
+        if not os.path.exists(os.path.join(self._directory, file_name)):
+            return False
+        with self._lock:
+            self._index[media['mediaId']] = file_name
+        return True
+
+    @staticmethod
+    def _file_name(media):
+        """File name of a media, from its id and content type"""
+        extension = mimetypes.guess_extension(
+            media.get('contentType') or '') or ''
+        return re.sub(r'[^\w.-]', '_', media['mediaId']) + extension
+
+    def media(self, giid=None):
+        """ Iterate over all media in the image series, newest first """
+        offset = 0
+        while True:
+            response = self._session.request(
+                self._session.cameras_image_series(
+                    limit=self._pagesize, offset=offset, giid=giid))
+            if 'errors' in response:
+                raise ResponseError(200, response['errors'])
+            search = response['data']['ContentProviderMediaSearch']
+            series_list = search['mediaSeriesList'] or []
+            for series in series_list:
+                for media in series['deviceMediaList'] or []:
+                    if media.get('contentUrl') \
+                            and media.get('mediaAvailable', True) is not False:
+                        yield media
+            offset += len(series_list)
+            if not series_list \
+                    or offset >= search['totalNumberOfMediaSeries']:
+                return
+
+    def _download(self, media):
+        file_name = self._file_name(media)
+        self._session.download_image(
+            media['contentUrl'],
+            os.path.join(self._directory, file_name),
+            resume=True)
+        with self._lock:
+            self._index[media['mediaId']] = file_name
+        return file_name
+
+    def download(self, giid=None):
+        """ Download all media not downloaded before
+
+        Args:
+            giid (str): Installation identifier, default is the set giid
+
+        Return a dict with the file name, or the raised Error, per mediaId
+        """
+        results = {}
+        futures = {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._max_workers) as executor:
+                for media in self.media(giid):
+                    media_id = media['mediaId']
+                    if media_id not in futures \
+                            and not self._is_downloaded(media):
+                        futures[media_id] = executor.submit(
+                            self._download, media)
+            for media_id, future in futures.items():
+                try:
+                    results[media_id] = future.result()
+                except Error as ex:
+                    LOGGER.warning(f"Download failed ({media_id=}, {ex=})")
+                    results[media_id] = ex
+        finally:
+            self._save_index()
+        LOGGER.info(f"Downloaded media ({len(results)=})")
+        return results
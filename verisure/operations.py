@@ -0,0 +1,124 @@
+'''
+Registry of graphql documents, encoded once per document
+'''
+
+import hashlib
+import logging
+import threading
+
+LOGGER = logging.getLogger(__package__)
+
+# Error code when the server does not know the hash of a persisted query
+PERSISTED_QUERY_NOT_FOUND = 'PERSISTED_QUERY_NOT_FOUND'
+
+_OPERATION_KEYS = frozenset(('operationName', 'variables', 'query'))
+_DOCUMENT_KEYS = frozenset(('operationName', 'query'))
+
+
+def _as_list(response):
+    return response if isinstance(response, list) else [response]
+
+
+def _without_end(content):
+    """Encoded json object without its closing brace, to add more keys"""
+    return content[:content.rindex(b'}')]
+
+
+class _Document(object):
+    """ The encoded static parts of the payload of one graphql document """
+
+    def __init__(self, name, query, codec):
+        self.sha256 = hashlib.sha256(query.encode()).hexdigest()
+        persisted_query = {'persistedQuery': {
+            'version': 1, 'sha256Hash': self.sha256}}
+        self.full = _without_end(codec.dumps({
+            'operationName': name, 'query': query}))
+        self.persisted = _without_end(codec.dumps({
+            'operationName': name, 'extensions': persisted_query}))
+        self.register = _without_end(codec.dumps({
+            'operationName': name, 'query': query,
+            'extensions': persisted_query}))
+
+
+class OperationRegistry(object):
+    """ Hold each graphql document once, with the static part of its payload
+    already encoded. Only the variables are encoded per request.
+
+    With persisted queries, operations are sent with the sha256 hash of the
+    document instead of the document itself.
+
+    Args:
+        codec (JsonCodec): json codec to encode payloads with
+
+    """
+
+    def __init__(self, codec):
+        self._codec = codec
+        self._documents = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._documents)
+
+    def _document(self, operation):
+        query = operation['query']
+        document = self._documents.get(query)
+        if document is None:
+            document = _Document(
+                operation['operationName'], query, self._codec)
+            with self._lock:
+                document = self._documents.setdefault(query, document)
+            LOGGER.debug(
+                f"Registered document ({operation['operationName']=})")
+        return document
+
+    def _encode(self, operation, persisted, register):
+        keys = operation.keys()
+        if not keys <= _OPERATION_KEYS or not keys >= _DOCUMENT_KEYS:
+            # Not a plain operation, encode it as it is
+            return self._codec.dumps(operation)
+        document = self._document(operation)
+        static = document.register if register \
+            else document.persisted if persisted else document.full
+        if 'variables' not in operation:
+            return static + b'}'
+        return b''.join((
+            static, b',"variables":',
+            self._codec.dumps(operation['variables']), b'}'))
+
+    def encode(self, operations, persisted=False, register=False):
+        """ Encode a request body for operations
+
+        Args:
+            operations (list): operations to request
+            persisted (bool): send the hash instead of the document
+            register (bool): send both the hash and the document, to
+                persist the document on the server
+        """
+        return b'[' + b','.join(
+            self._encode(operation, persisted, register)
+            for operation in operations) + b']'
+
+    @staticmethod
+    def not_persisted(response):
+        """ Get the indexes of the operations in a response which the server
+        has no persisted document for
+        """
+        return [
+            index for index, result in enumerate(_as_list(response))
+            if isinstance(result, dict) and any(
+                isinstance(error, dict) and (
+                    (error.get('extensions') or {}).get('code')
+                    == PERSISTED_QUERY_NOT_FOUND
+                    or error.get('message') == 'PersistedQueryNotFound')
+                for error in result.get('errors') or [])]
+
+    @staticmethod
+    def replace(response, indexes, registered):
+        """ Replace the results of operations in a response with the results
+        from requesting them again
+        """
+        results = _as_list(response).copy()
+        for index, result in zip(indexes, _as_list(registered)):
+            results[index] = result
+        return results if isinstance(response, list) else results[0]
@@ -0,0 +1,166 @@
+'''
+Token bucket rate limiting of api calls
+'''
+
+import email.utils
+import logging
+import threading
+import time
+
+LOGGER = logging.getLogger(__package__)
+
+# Seconds to hold back calls after a throttled response without Retry-After
+DEFAULT_RETRY_AFTER = 1
+
+
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header value, in seconds or as an
+    http date, None if it can not be parsed
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+class _TokenBucket(object):
+    """ Bucket of `burst` tokens refilled with `rate` tokens per second,
+    unlimited if rate is None
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+
+    def reserve(self, now):
+        """ Take a token, return the seconds until it is available """
+        wait = max(self.paused_until - now, 0)
+        if self.rate:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+        return wait
+
+
+class RateLimiter(object):
+    """ Limit api calls per account and per base url with token buckets
+
+    Calls wait for a token from both the account bucket and the bucket of
+    the base url. A throttled response holds back calls to its base url
+    for the time in its Retry-After header. Share one limiter between the
+    sessions of an account.
+
+    Args:
+        rate (float): calls per second per account, None for no limit
+        burst (int): calls per account allowed at once
+        endpoint_rate (float): calls per second per base url, None for no
+            limit
+        endpoint_burst (int): calls per base url allowed at once
+        max_wait (float): max seconds to hold back a throttled call, calls
+            throttled for longer fail instead
+
+    """
+
+    def __init__(self, rate=None, burst=10, endpoint_rate=None,
+                 endpoint_burst=10, max_wait=60):
+        self._account = _TokenBucket(rate, burst)
+        self._endpoint_rate = endpoint_rate
+        self._endpoint_burst = endpoint_burst
+        self._endpoints = {}
+        self._max_wait = max_wait
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._throttled = 0
+
+    def _bucket(self, base_url):
+        bucket = self._endpoints.get(base_url)
+        if bucket is None:
+            bucket = self._endpoints[base_url] = _TokenBucket(
+                self._endpoint_rate, self._endpoint_burst)
+        return bucket
+
+    def _paused(self, base_url, now):
+        endpoint = self._endpoints.get(base_url)
+        paused_until = self._account.paused_until
+        if endpoint is not None:
+            paused_until = max(paused_until, endpoint.paused_until)
+        return max(paused_until - now, 0)
+
+    def order(self, base_urls):
+        """ Sort base urls by how long calls to them are held back, keeping
+        the order of those that are not
+        """
+        now = time.monotonic()
+        with self._lock:
+            return sorted(
+                base_urls, key=lambda base_url: self._paused(base_url, now))
+
+    def acquire(self, base_url):
+        """ Reserve a call to a base url
+
+        Return the seconds to wait before the call, or None if the base url
+        is throttled for longer than max_wait
+        """
+        now = time.monotonic()
+        with self._lock:
+            if self._paused(base_url, now) > self._max_wait:
+                return None
+            endpoint = self._bucket(base_url)
+            wait = max(self._account.reserve(now), endpoint.reserve(now))
+            self._calls += 1
+            if wait > 0:
+                self._waits += 1
+                self._wait_time += wait
+                self._max_wait_time = max(self._max_wait_time, wait)
+        if wait > 0:
+            LOGGER.debug(f"Rate limited ({base_url=}, {wait=})")
+        return wait
+
+    def throttled(self, base_url, retry_after=None):
+        """ Hold back calls to a base url after a throttled response
+
+        Args:
+            base_url (str): base url of the throttled call
+            retry_after (str): value of the Retry-After header, if any
+
+        Return the seconds calls are held back
+        """
+        seconds = parse_retry_after(retry_after)
+        if seconds is None:
+            seconds = DEFAULT_RETRY_AFTER
+        with self._lock:
+            endpoint = self._bucket(base_url)
+            endpoint.paused_until = max(
+                endpoint.paused_until, time.monotonic() + seconds)
+            self._throttled += 1
+        LOGGER.warning(f"Throttled ({base_url=}, {seconds=})")
+        return seconds
+
+    def stats(self):
+        """ Get counts of calls, calls that waited, throttled responses and
+        the total and max seconds calls waited
+        """
+        with self._lock:
+            return {
+                'calls': self._calls,
+                'waits': self._waits,
+                'wait_time': self._wait_time,
+                'max_wait_time': self._max_wait_time,
+                'throttled': self._throttled,
+            }
@@ -0,0 +1,281 @@
+'''
+Reduce graphql documents to a subset of their fields, and merge documents
+'''
+
+import functools
+import re
+
+_NAME = re.compile(r'[_A-Za-z][_0-9A-Za-z]*')
+_VARIABLE = re.compile(r'\$(\w+)\s*:\s*([\w\[\]!]+)')
+_IGNORED = ' \t\r\n,'
+
+
+class _Selection(object):
+    """ A field or inline fragment in a selection set
+
+    Attributes:
+        head (str): text before the selection set, as in the document
+        name (str): response key of a field, None for an inline fragment
+        children (list): selections in its selection set, or None
+    """
+
+    def __init__(self, head, name, children):
+        self.head = head
+        self.name = name
+        self.children = children
+
+    def copy(self, children):
+        return _Selection(self.head, self.name, children)
+
+    def __str__(self):
+        if self.children is None:
+            return self.head
+        return f"{self.head} {{{' '.join(map(str, self.children))}}}"
+
+
+def _skip(text, pos):
+    while pos < len(text) and text[pos] in _IGNORED:
+        pos += 1
+    return pos
+
+
+def _skip_arguments(text, pos):
+    """Get the position after the arguments starting at pos"""
+    depth = 0
+    while True:
+        char = text[pos]
+        if char == '"':
+            pos = text.index('"', pos + 1)
+            while text[pos - 1] == '\\':
+                pos = text.index('"', pos + 1)
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth -= 1
+            if not depth:
+                return pos + 1
+        pos += 1
+
+
+def _parse_selections(text, pos):
+    """ Parse the selection set after the '{' at pos - 1
+
+    Return the selections and the position after the closing '}'
+    """
+    selections = []
+    while True:
+        pos = _skip(text, pos)
+        if text[pos] == '}':
+            return selections, pos + 1
+        start = pos
+        if text.startswith('...', pos):
+            name = None
+            pos = text.index('{', pos)
+            head = text[start:pos].strip()
+        else:
+            name = _NAME.match(text, pos).group()
+            pos = _skip(text, pos + len(name))
+            if text[pos] == ':':
+                # Aliased field, skip the field name
+                pos = _skip(text, pos + 1)
+                pos = _skip(text, _NAME.match(text, pos).end())
+            if text[pos] == '(':
+                pos = _skip(text, _skip_arguments(text, pos))
+            head = text[start:pos].strip()
+        children = None
+        if text[pos] == '{':
+            children, pos = _parse_selections(text, pos + 1)
+        selections.append(_Selection(head, name, children))
+
+
+def _field_tree(fields):
+    """Convert dotted field paths to a tree of dicts"""
+    tree = {}
+    for field in fields:
+        node = tree
+        for name in field.split('.'):
+            node = node.setdefault(name, {})
+    return tree
+
+
+def _pick(selections, tree):
+    """ Select the fields in tree, return the selections and the names of
+    the fields found
+    """
+    picked = []
+    found = set()
+    for selection in selections:
+        if selection.name is None:
+            children, fragment_found = _pick(selection.children, tree)
+            found |= fragment_found
+            if children:
+                picked.append(selection.copy(children))
+        elif selection.name in tree:
+            found.add(selection.name)
+            subtree = tree[selection.name]
+            if not subtree:
+                picked.append(selection)
+                continue
+            if selection.children is None:
+                raise ValueError(f"Field has no fields: {selection.name}")
+            children, child_found = _pick(selection.children, subtree)
+            missing = subtree.keys() - child_found
+            if missing:
+                raise ValueError(f"Unknown fields: {sorted(missing)}")
+            picked.append(selection.copy(children))
+    return picked, found
+
+
+def _reduce(selections, root, tree):
+    """Keep everything outside root, and only the fields in tree below it"""
+    if not root:
+        picked, found = _pick(selections, tree)
+        missing = tree.keys() - found
+        if missing:
+            raise ValueError(f"Unknown fields: {sorted(missing)}")
+        return picked
+    reduced = []
+    for selection in selections:
+        if selection.children is not None and (
+                selection.name is None or selection.name == root[0]):
+            remaining = root if selection.name is None else root[1:]
+            selection = selection.copy(
+                _reduce(selection.children, remaining, tree))
+        reduced.append(selection)
+    return reduced
+
+
+def _parse_document(query):
+    """Get the header and the root selections of a graphql document"""
+    start = query.index('{')
+    selections, _ = _parse_selections(query, start + 1)
+    return query[:start].strip(), selections
+
+
+@functools.lru_cache(maxsize=128)
+def _select_fields(query, root, fields):
+    header, selections = _parse_document(query)
+    reduced = _reduce(
+        selections, root.split('.') if root else [], _field_tree(fields))
+    return f"{header} {{{' '.join(map(str, reduced))}}}"
+
+
+def select_fields(query, root, fields):
+    """ Reduce a graphql document to a subset of the fields below root
+
+    Fields outside root are kept. Generated documents are cached per query,
+    root and set of fields.
+
+    Args:
+        query (str): graphql document
+        root (str): dotted path of the field to select fields of
+        fields (list): dotted paths of the fields to keep, relative to root,
+            a field with its own fields is kept whole unless they are given
+
+    Raise ValueError for fields not in the document
+    """
+    if not fields:
+        raise ValueError("No fields selected")
+    return _select_fields(query, root, tuple(sorted(set(fields))))
+
+
+def _field(selection):
+    """Head of a field selection without its alias"""
+    head = selection.head[len(selection.name):].lstrip()
+    if head.startswith(':'):
+        return head[1:].lstrip()
+    return selection.head
+
+
+@functools.lru_cache(maxsize=32)
+def _merge_installation(documents):
+    variables = {}
+    root = None
+    children = []
+    plan = []
+    for name, query in documents:
+        header, selections = _parse_document(query)
+        if not header.startswith('query') or len(selections) != 1 \
+                or selections[0].name != 'installation' \
+                or selections[0].children is None:
+            raise ValueError(f"Not an installation query: {name}")
+        head = re.sub(r'\s+', '', selections[0].head)
+        if root not in (None, head):
+            raise ValueError(f"Different installation arguments: {name}")
+        root = head
+        for variable, variable_type in _VARIABLE.findall(header):
+            if variables.setdefault(variable, variable_type) \
+                    != variable_type:
+                raise ValueError(f"Different variable types: ${variable}")
+        keys = []
+        for selection in selections[0].children:
+            if selection.name == '__typename':
+                continue
+            if selection.name is None:
+                raise ValueError(f"Fragment in installation query: {name}")
+            alias = f'{name}_{selection.name}'
+            keys.append((alias, selection.name))
+            children.append(_Selection(
+                f'{alias}: {_field(selection)}', alias, selection.children))
+        plan.append(keys)
+    definitions = ', '.join(
+        f'${variable}: {variable_type}'
+        for variable, variable_type in variables.items())
+    query = (
+        f"query Snapshot({definitions}) {{{selections[0].head} "
+        f"{{{' '.join(map(str, children))} __typename}}}}")
+    return query, tuple(map(tuple, plan))
+
+
+def merge_installation(operations):
+    """ Merge operations on one installation into a single operation
+
+    The fields selected on the installation by each operation are aliased
+    with the operationName, so the installation is resolved once.
+
+    Return the merged operation and the plan to split its response with
+    `split_installation`. Raise ValueError for operations that can not be
+    merged.
+    """
+    names = [operation['operationName'] for operation in operations]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Duplicate operations: {names}")
+    variables = {}
+    for operation in operations:
+        for variable, value in operation.get('variables', {}).items():
+            if variables.setdefault(variable, value) != value:
+                raise ValueError(f"Different variable values: ${variable}")
+    query, plan = _merge_installation(tuple(
+        (operation['operationName'], operation['query'])
+        for operation in operations))
+    return {
+        'operationName': 'Snapshot',
+        'variables': variables,
+        'query': query,
+    }, plan
+
+
+def split_installation(response, plan):
+    """ Split the response of a merged operation into a response per
+    operation, shaped like the responses to the operations themselves
+    """
+    installation = (response.get('data') or {}).get('installation')
+    responses = []
+    for keys in plan:
+        aliases = {alias for alias, _ in keys}
+        if installation is None:
+            data = {'installation': None}
+        else:
+            data = {'installation': dict(
+                [(key, installation.get(alias)) for alias, key in keys]
+                + [('__typename', installation.get('__typename'))])}
+        split = {'data': data}
+        errors = [
+            error for error in response.get('errors') or []
+            if not isinstance(error, dict)
+            or len(error.get('path') or []) < 2
+            or error['path'][1] in aliases]
+        if errors:
+            split['errors'] = errors
+        responses.append(split)
+    return responses
@@ -2,15 +2,59 @@
 Verisure session, using verisure app api
 '''
 
-import json
+import concurrent.futures
+import http.cookiejar
+import io
 import logging
 import os
-import pickle
+import threading
+import time
 
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from .backoff import backoff_delays
+from .cache import is_mutation, operation_key
+from .codec import JsonCodec
+from .cookies import CookieStore
+from .endpoints import Endpoints
+from .operations import OperationRegistry
+from .ratelimit import RateLimiter
+from .selection import (
+    merge_installation,
+    select_fields,
+    split_installation,
+)
 
 LOGGER = logging.getLogger(__package__)
 
+# Seconds a cookie lasts before it needs to be updated
+COOKIE_LIFETIME = 15 * 60
+# Seconds to wait before retrying a failed cookie refresh
+COOKIE_REFRESH_RETRY = 10
+# Seconds to wait before hedging a request to a base url without latency
+HEDGE_DELAY = 1
+# Times to retry a call after every base url throttled it
+RATE_LIMIT_RETRIES = 3
+
+# Mutations with a state change that can be polled, per operationName the
+# response field with the transaction id and the future state
+POLLED_MUTATIONS = {
+    'armAway': ('armStateArmAway', 'ARMED_AWAY'),
+    'armHome': ('armStateArmHome', 'ARMED_HOME'),
+    'disarm': ('armStateDisarm', 'DISARMED'),
+    'DoorLock': ('DoorLock', 'LOCKED'),
+    'DoorUnlock': ('DoorUnlock', 'UNLOCKED'),
+}
+
+# Bytes of the buffer images are streamed through
+IMAGE_BUFFER_SIZE = 256 * 1024
+
+EVENT_CATEGORIES = [
+    "INTRUSION", "FIRE", "SOS", "WATER", "ANIMAL", "TECHNICAL", "WARNING",
+    "ARM", "DISARM", "LOCK", "UNLOCK", "PICTURE", "CLIMATE", "CAMERA_SETTINGS"]
+
 
 class Error(Exception):
     ''' Verisure session error '''
@@ -28,6 +72,10 @@ class LogoutError(Error):
     ''' Logout failed '''
 
 
+class PollTimeoutError(Error):
+    ''' State change did not complete in time '''
+
+
 class ResponseError(Error):
     ''' Unexcpected response '''
     def __init__(self, status_code, text):
@@ -35,12 +83,55 @@ class ResponseError(Error):
             f'Invalid response, status code: {status_code} - Data: {text}')
 
 
+class RateLimitError(ResponseError):
+    ''' Too many requests '''
+    def __init__(self, status_code, text, retry_after=None):
+        super().__init__(status_code, text)
+        self.retry_after = retry_after
+
+
 def query_func(f):
     """A wrapper that indicates that the function is a query (used by CLI)"""
     f.is_query = True
     return f
 
 
+class _ImageReader(io.RawIOBase):
+    """
+    Read the body of a streamed response, release the connection to the pool
+    when closed after the whole body is read.
+    """
+
+    def __init__(self, response):
+        super().__init__()
+        self._response = response
+        self._response.raw.decode_content = True
+        self._eof = False
+
+    @property
+    def status_code(self):
+        """Status code of the response"""
+        return self._response.status_code
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            size = self._response.raw.readinto(buffer)
+        except urllib3.exceptions.HTTPError as ex:
+            raise RequestError("Failed to read image") from ex
+        self._eof = size == 0
+        return size
+
+    def close(self):
+        if not self.closed:
+            if self._eof:
+                self._response.raw.release_conn()
+            self._response.close()
+        super().close()
+
+
 class VariableTypes:
     """Types for query parameters"""
     class DeviceLabel(str):
@@ -73,84 +164,428 @@ class Session(object):
         username (str): Username used to login to verisure app
         password (str): Password used to login to verisure app
         cookie_file_name (str): path to cookie file
-
+        pool_connections (int): number of hosts to keep connection pools for
+        pool_maxsize (int): max number of kept-alive connections per host
+        pool_block (bool): block when all connections to a host are in use
+            instead of opening an extra, non-pooled connection
+        cache (ResponseCache): cache for responses to read-only operations
+        coalesce (bool): share the response to identical read-only requests
+            already in flight instead of sending them again, the response
+            is then shared between callers and must not be modified
+        base_urls (list): api base urls to fail over between
+        persist_endpoints (bool): keep the health of the base urls in a file
+            next to the cookie file, so it survives restarts
+        timeout (float): max seconds to wait for each api call, or None
+        hedge (float): latency percentile (0-1) of the preferred base url
+            after which read-only requests are also sent to the next one,
+            the first usable response is used. None disables hedging
+        codec (JsonCodec): json codec for request and response bodies,
+            default is the standard library
+        persisted_queries (bool): send the hash of each graphql document
+            instead of the document, once the server has persisted it
+        rate_limiter (RateLimiter): limits the rate of api calls, share one
+            between the sessions of an account. Default only holds back
+            calls after the server throttled them
+        cookie_store (CookieStore): where to keep the cookies, default is
+            the cookie file
+
+    The session owns a pool of persistent connections, call `close` (or use
+    the session as a context manager) to release them.
     """
 
     def __init__(self, username, password,
-                 cookie_file_name='~/.verisure-cookie'):
+                 cookie_file_name='~/.verisure-cookie',
+                 pool_connections=2, pool_maxsize=10, pool_block=False,
+                 cache=None, coalesce=False, base_urls=None,
+                 persist_endpoints=False, timeout=None, hedge=None,
+                 codec=None, persisted_queries=False, rate_limiter=None,
+                 cookie_store=None):
         LOGGER.info(f"Initialize Session ({username=}, {cookie_file_name=})")
         self._username = username
         self._password = password
         self._cookies = None
         self._cookie_file_name = os.path.expanduser(cookie_file_name)
+        self._cookie_store = cookie_store or CookieStore(
+            self._cookie_file_name)
         self._trust_token = None
+        self._cookie_time = None
+        self._refresher = None
+        self._auth_lock = threading.Lock()
+        self._cache = cache
+        self._coalesce = coalesce
+        self._in_flight = {}
+        self._in_flight_lock = threading.Lock()
+        self._mutation_callbacks = []
         self._giid = None
         self._base_url = None
-        self._base_urls = ['https://automation01.verisure.com',
-                           'https://automation02.verisure.com']
-        self._post = self._wrap_request(requests.post)
-        self._delete = self._wrap_request(requests.delete)
-        self._get = self._wrap_request(requests.get)
-
+        self._endpoints = Endpoints(
+            base_urls,
+            file_name=persist_endpoints
+            and f'{self._cookie_file_name}-endpoints')
+        self._timeout = timeout
+        self._codec = codec or JsonCodec()
+        self._operations = OperationRegistry(self._codec)
+        self._persisted_queries = persisted_queries
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._hedge = hedge
+        self._hedge_executor = None
+        self._hedge_lock = threading.Lock()
+        self._pool_maxsize = pool_maxsize
+        self._init_transport(pool_connections, pool_maxsize, pool_block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _init_transport(self, pool_connections, pool_maxsize, pool_block):
+        """
+        Create the pooled http session shared by all calls. Cookies are always
+        passed explicitly, so the session must not collect any on its own.
+        """
+        self._http = requests.Session()
+        self._http.cookies.set_policy(
+            http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            pool_block=pool_block)
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+        self._post = self._wrap_request(self._http.post)
+        self._delete = self._wrap_request(self._http.delete)
+        self._get = self._wrap_request(self._http.get)
+
+    def close(self):
+        """Stop cookie refresh and close all pooled connections"""
+        self.stop_cookie_refresh()
+        self._endpoints.save()
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait=False)
+        self._http.close()
+
+    @property
+    def rate_limiter(self):
+        """Rate limiter of the api calls, see `RateLimiter.stats`"""
+        return self._rate_limiter
+
+    def _base_urls(self):
+        """Base urls to try, the healthiest, fastest and not throttled first"""
+        return self._rate_limiter.order(self._endpoints.ordered())
 
     def _wrap_request(self, function):
         """
-        Used to wrap methods from the requests module to try both urls and remember
-        the last working one.
+        Used to wrap methods from the requests module to try the base urls, the
+        healthiest and fastest first, and track their health. The wrapped
+        methods return the response and its parsed json body. Calls throttled
+        by every base url are retried after the time the server asked for.
         """
 
-        def wrapper(url, *args, **kwargs):
+        def attempt(url, *args, **kwargs):
             last_exception = Error("Unknown error")
-            base_urls = self._base_urls.copy()
-            for base_url in base_urls:
-                try:
-                    response = function(base_url+url, *args, **kwargs)
-                    if response.status_code > 200 or "errors" in response.text:
-                        LOGGER.debug(
-                            f"{response.request.method} {response.request.url} "
-                            f"{response.status_code} f{response.text}"
-                        )
-                    if response.status_code >= 500:
-                        last_exception = ResponseError(response.status_code, response.text)
-                        self._base_urls.reverse()
-                        continue
-                    if response.status_code >= 400:
-                        last_exception = LoginError(response.text)
-                        break
-                    if response.status_code == 200:
-                        if "SYS_00004" in response.text:
-                            self._base_urls.reverse()
-                            continue
-                        return response
- 
-                except requests.exceptions.RequestException as ex:
-                    LOGGER.warning(f"Unexpected error on '{base_url}{url}' ({ex=})")
-                    last_exception = RequestError(str(ex))
-                self._base_urls.reverse()
+            for base_url in self._base_urls():
+                response, data, last_exception = self._send(
+                    function, base_url, url, *args, **kwargs)
+                if last_exception is None:
+                    return response, data
             raise last_exception
+
+        def wrapper(url, *args, **kwargs):
+            return self._retry_throttled(attempt, url, *args, **kwargs)
         return wrapper
 
+    @staticmethod
+    def _retry_throttled(attempt, *args, **kwargs):
+        """
+        Call attempt, and call it again while every base url throttles it.
+        The base urls then hold back the call for the time the server asked
+        for.
+        """
+        for retries in range(RATE_LIMIT_RETRIES, -1, -1):
+            try:
+                return attempt(*args, **kwargs)
+            except RateLimitError:
+                if not retries:
+                    raise
+
+    def _throttled(self, base_url, error, retry_after):
+        """
+        Hold back calls to a base url that throttled a call. The base url is
+        healthy, so neither success nor failure is tracked.
+        """
+        error.retry_after = self._rate_limiter.throttled(base_url, retry_after)
+        return None, None, error
+
+    def _send(self, function, base_url, url, *args, **kwargs):
+        """
+        Send a request to one base url and track its health. Return the
+        response, its parsed json body and the error to fail over to the next
+        base url on.
+        """
+        kwargs.setdefault('timeout', self._timeout)
+        delay = self._rate_limiter.acquire(base_url)
+        if delay is None:
+            return None, None, RateLimitError(429, f"Throttled: {base_url}")
+        time.sleep(delay)
+        start = time.monotonic()
+        try:
+            response = function(base_url+url, *args, **kwargs)
+            data = self._parse_body(response.content)
+            try:
+                error = self._check_response(
+                    response.request.method, response.request.url,
+                    response.status_code, response.content, data)
+            except LoginError:
+                self._success(base_url, start)
+                raise
+            if error is None:
+                self._success(base_url, start)
+                return response, data, None
+            if isinstance(error, RateLimitError):
+                return self._throttled(
+                    base_url, error, response.headers.get('Retry-After'))
+        except requests.exceptions.RequestException as ex:
+            LOGGER.warning(f"Unexpected error on '{base_url}{url}' ({ex=})")
+            error = RequestError(str(ex))
+        self._failure(base_url)
+        return None, None, error
+
+    def _success(self, base_url, start):
+        """Track a response from a base url to a request sent at start"""
+        if self._endpoints.success(base_url, time.monotonic() - start):
+            self._endpoints.save()
+
+    def _failure(self, base_url):
+        """Track a failed request to a base url"""
+        if self._endpoints.failure(base_url):
+            self._endpoints.save()
+
+    def _hedged_post(self, url, **kwargs):
+        """
+        Post to the preferred base url, and also to the next one when there is
+        no answer within the hedge percentile of its latency or it fails.
+        Return the first usable response and its parsed json body. Calls
+        throttled by every base url are retried after the time the server
+        asked for.
+        """
+        return self._retry_throttled(self._hedged_attempt, url, **kwargs)
+
+    def _hedged_attempt(self, url, **kwargs):
+        """Post once to the base urls for `_hedged_post`"""
+        base_urls = self._base_urls()
+        deadline = self._timeout and time.monotonic() + self._timeout
+        with self._hedge_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self._pool_maxsize,
+                    thread_name_prefix='verisure-hedge')
+        last_exception = Error("Unknown error")
+        pending = set()
+        hedge_time = time.monotonic()
+        while True:
+            now = time.monotonic()
+            if base_urls and (not pending or now >= hedge_time):
+                base_url = base_urls.pop(0)
+                if pending:
+                    LOGGER.debug(f"Hedge request ({base_url=}, {url=})")
+                pending.add(self._hedge_executor.submit(
+                    self._send, self._http.post, base_url, url,
+                    **dict(kwargs, timeout=deadline and deadline - now)))
+                hedge_time = now + (self._endpoints.latency_percentile(
+                    base_url, self._hedge) or HEDGE_DELAY)
+            if not pending:
+                raise last_exception
+            timeouts = [
+                hedge_time - now if base_urls else None,
+                deadline and deadline - now]
+            timeouts = [timeout for timeout in timeouts if timeout is not None]
+            done, pending = concurrent.futures.wait(
+                pending, timeout=max(min(timeouts), 0) if timeouts else None,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                response, data, last_exception = future.result()
+                if last_exception is None:
+                    return response, data
+            if deadline and time.monotonic() >= deadline and pending:
+                raise RequestError(f"No response within {self._timeout}s")
+
+    def _parse_body(self, content):
+        """Parse a json response body, None if it is empty or not json"""
+        if not content:
+            return None
+        try:
+            return self._codec.loads(content)
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _operation_errors(data):
+        """
+        Get the graphql errors of a parsed response per operation, keyed by
+        the index of the operation in the request.
+        """
+        responses = data if isinstance(data, list) else [data]
+        return {
+            index: response['errors']
+            for index, response in enumerate(responses)
+            if isinstance(response, dict) and response.get('errors')}
+
+    @staticmethod
+    def _error_code(error):
+        """Get the error code of a graphql error, or None"""
+        if not isinstance(error, dict):
+            return None
+        details = error.get('data') or error.get('extensions') or {}
+        return details.get('errorCode') or details.get('code')
+
+    @classmethod
+    def _check_response(cls, method, url, status_code, content, data):
+        """
+        Check a response, raise on login errors and return the error to fail
+        over to the next base url on, or None if the response is usable.
+        Errors of single operations are left in the response to the caller,
+        unless the service is unavailable. Throttled calls return a
+        RateLimitError.
+        """
+        errors = cls._operation_errors(data)
+        if status_code > 200 or errors:
+            LOGGER.debug(f"{method} {url} {status_code} {content!r}")
+        if status_code >= 500:
+            return ResponseError(status_code, content.decode(errors='replace'))
+        if status_code == 429:
+            return RateLimitError(
+                status_code, content.decode(errors='replace'))
+        if status_code >= 400:
+            raise LoginError(content.decode(errors='replace'))
+        if status_code != 200:
+            return ResponseError(status_code, content.decode(errors='replace'))
+        unavailable = [
+            index for index, operation_errors in errors.items()
+            if any(cls._error_code(error) == 'SYS_00004'
+                   for error in operation_errors)]
+        if unavailable:
+            LOGGER.warning(f"Service unavailable ({url=}, {unavailable=})")
+            return ResponseError(status_code, content.decode(errors='replace'))
+        return None
+
+    def _save_cookies(self):
+        """Store cookies in the cookie file"""
+        self._cookie_time = time.monotonic()
+        self._cookie_store.save(self._cookies)
+
+    def _load_cookies(self):
+        """Load cookies from the cookie file"""
+        try:
+            self._cookies = self._cookie_store.load()
+        except Exception as ex:
+            raise LoginError("Failed to read cookie") from ex
+
+    def _reload_cookies(self):
+        """
+        Use the cookies in the cookie file if another process has stored new
+        ones since they were last read or written. Return True if they were
+        reloaded.
+        """
+        if not self._cookie_store.changed():
+            return False
+        try:
+            self._load_cookies()
+        except LoginError as ex:
+            LOGGER.info(f"Failed to reload cookie ({ex=})")
+            return False
+        self._cookie_time = time.monotonic() - (self._cookie_store.age() or 0)
+        LOGGER.info("Reloaded cookie stored by another process")
+        return True
+
+    def _trust_cookies(self):
+        """Cookies used to skip MFA on login"""
+        cookie_jar = requests.sessions.RequestsCookieJar()
+        for name, value in self._cookies.items():
+            if 'vs-trust' in name:
+                cookie_jar.set(name, value)
+        return cookie_jar
+
+    def _refresh_cookies(self):
+        """Cookies used to refresh an expired cookie"""
+        cookie_jar = requests.sessions.RequestsCookieJar()
+        if self._cookies is not None:
+            for name, value in self._cookies.items():
+                if name in ['vid', 'vs-refresh']:
+                    cookie_jar[name] = value
+        return cookie_jar
+
+    def _clear(self):
+        """Forget login state and remove the cookie file"""
+        self._base_url = None
+        self._giid = None
+        self._cookies = None
+        self._cookie_time = None
+        self._trust_token = None
+        self._cookie_store.remove()
+
+    def load_cookie(self):
+        """ Use the cookie in the cookie file without logging in, e.g. one
+        stored by another process sharing the account
+        Return True if a cookie younger than its lifetime was loaded
+        """
+        with self._auth_lock:
+            return self._load_fresh_cookies()
+
+    def _load_fresh_cookies(self):
+        """Load the stored cookies if they have not expired"""
+        age = self._cookie_store.age()
+        if age is None or age >= COOKIE_LIFETIME:
+            return False
+        try:
+            self._load_cookies()
+        except LoginError as ex:
+            LOGGER.info(f"Failed to load cookie ({ex=})")
+            return False
+        self._cookie_time = time.monotonic() - age
+        return True
+
+    def _stored_login(self):
+        """ Reuse a stored cookie that has not expired
+        Return installations, or None if there is no usable cookie
+        """
+        if not self._load_fresh_cookies():
+            return None
+        try:
+            installations = self._request(self.fetch_all_installations())
+        except LoginError as ex:
+            LOGGER.info(f"Stored cookie not accepted ({ex=})")
+            return None
+        if 'errors' in installations:
+            return None
+        LOGGER.info("Logged in using the stored cookie")
+        return installations
 
     def login(self):
         """ Login to verisure app api
-        Login before calling any read or write commands
+        Login before calling any read or write commands. A cookie stored by
+        another process sharing the cookie file is reused while it lasts.
         Return installations
         """
+        with self._auth_lock, self._cookie_store:
+            return self._stored_login() or self._login()
 
-        response = self._post(
+    def _login(self):
+        """Login using the password"""
+
+        response, data = self._post(
             "/auth/login",
             headers={'APPLICATION_ID': 'PS_PYTHON'},
             auth=(self._username, self._password))
 
-        if "stepUpToken" in response.text:
+        if isinstance(data, dict) and "stepUpToken" in data:
             raise LoginError("Multifactor authentication enabled, "
                              "disable or create MFA cookie")
 
         self._cookies = response.cookies
-        with open(self._cookie_file_name, 'wb') as f:
-            pickle.dump(self._cookies, f)
+        self._save_cookies()
 
-        installations = self.get_installations()
+        installations = self._request(self.fetch_all_installations())
         if 'errors' not in installations:
             return installations
 
@@ -159,19 +594,19 @@ class Session(object):
     def request_mfa(self):
         """ Request MFA verification code """
 
-        response = self._post(
+        response, data = self._post(
             url="/auth/login",
             headers={'APPLICATION_ID': 'PS_PYTHON'},
             auth=(self._username, self._password))
 
-        if "stepUpToken" not in response.text:
+        if not isinstance(data, dict) or "stepUpToken" not in data:
             raise LoginError("Multifactor authentication disabled, "
                              "use regular login instead")
 
         self._cookies = response.cookies
         for mfa_type in ['phone', 'email']:
             try:
-                mfa_response = self._post(
+                mfa_response, _ = self._post(
                     url=f"/auth/mfa?type={mfa_type}",
                     headers={'APPLICATION_ID': 'PS_PYTHON'},
                     cookies=self._cookies)
@@ -187,17 +622,17 @@ class Session(object):
         Return installations
         """
 
-        response = self._post(
+        response, _ = self._post(
             url="/auth/mfa/validate",
             headers={
                 'APPLICATION_ID': 'PS_PYTHON',
                 'Accept': 'application/json',
                 'Content-Type': 'application/json'},
             cookies=self._cookies,
-            data=json.dumps({"token": code}))
+            data=self._codec.dumps({"token": code}))
         self._cookies = response.cookies
 
-        trust_response = self._post(
+        trust_response, trust_token = self._post(
             url="/auth/trust",
             headers={
                 'APPLICATION_ID': 'PS_PYTHON',
@@ -205,11 +640,10 @@ class Session(object):
             },
             cookies=self._cookies)
         self._cookies.update(trust_response.cookies)
-        with open(self._cookie_file_name, 'wb') as cookie_file:
-            pickle.dump(self._cookies, cookie_file)
-        self._trust_token = trust_response.json()
+        self._save_cookies()
+        self._trust_token = trust_token
 
-        installations = self.get_installations()
+        installations = self._request(self.fetch_all_installations())
         if 'errors' not in installations:
             return installations
 
@@ -217,31 +651,29 @@ class Session(object):
 
     def login_cookie(self):
         """ Login using cookie
+        A cookie stored by another process sharing the cookie file is reused
+        while it lasts.
         Return installations
         """
+        with self._auth_lock, self._cookie_store:
+            return self._stored_login() or self._login_cookie()
+
+    def _login_cookie(self):
+        """Login using the trust cookie in the cookie file"""
 
         # Load cookie from file
-        try:
-            with open(self._cookie_file_name, 'rb') as cookie_file:
-                self._cookies = pickle.load(cookie_file)
-        except Exception as ex:
-            raise LoginError("Failed to read cookie") from ex
+        self._load_cookies()
 
         # Login
-        cookie_jar = requests.sessions.RequestsCookieJar()
-        for name, value in self._cookies.items():
-            if 'vs-trust' in name:
-                cookie_jar.set(name, value)
-        response = self._post(
+        response, _ = self._post(
             url="/auth/login",
             headers={'APPLICATION_ID': 'PS_PYTHON'},
             auth=(self._username, self._password),
-            cookies=cookie_jar)
+            cookies=self._trust_cookies())
         self._cookies.update(response.cookies)
-        with open(self._cookie_file_name, 'wb') as f:
-            pickle.dump(self._cookies, f)
+        self._save_cookies()
 
-        installations = self.get_installations()
+        installations = self._request(self.fetch_all_installations())
         if 'errors' not in installations:
             return installations
 
@@ -252,21 +684,72 @@ class Session(object):
         Cookie can last 15 minutes before it needs to be updated.
         """
 
-        cookie_jar = requests.sessions.RequestsCookieJar()
-        if self._cookies is not None:
-            for name, value in self._cookies.items():
-                if name in ['vid', 'vs-refresh']:
-                    cookie_jar[name] = value
-        response = self._get(
+        response, _ = self._get(
             url="/auth/token",
             headers={'APPLICATION_ID': 'PS_PYTHON'},
-            cookies=cookie_jar)
+            cookies=self._refresh_cookies())
 
-        self._cookies.update(response.cookies)
-        with open(self._cookie_file_name, 'wb') as cookie_file:
-            pickle.dump(self._cookies, cookie_file)
+        cookies = self._cookies.copy()
+        cookies.update(response.cookies)
+        self._cookies = cookies
+        self._save_cookies()
         LOGGER.debug(f"Saved cookies: {[cookie for cookie in self._cookies.keys()]}")
 
+    def _cookie_refresh_delay(self, margin):
+        """Seconds until the cookie should be refreshed"""
+        if self._cookie_time is None:
+            # Not logged in yet, check again soon
+            return 1
+        return self._cookie_time + COOKIE_LIFETIME - margin - time.monotonic()
+
+    def start_cookie_refresh(self, margin=60):
+        """ Keep the cookie updated in a background thread
+
+        Args:
+            margin (int): seconds before expiry to update the cookie
+        """
+        if self._refresher is not None:
+            return
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._cookie_refresh_loop,
+            args=(margin, stop),
+            name='verisure-cookie-refresh',
+            daemon=True)
+        self._refresher = (thread, stop)
+        thread.start()
+        LOGGER.info(f"Cookie refresh started ({margin=})")
+
+    def stop_cookie_refresh(self):
+        """ Stop updating the cookie in the background """
+        if self._refresher is None:
+            return
+        thread, stop = self._refresher
+        self._refresher = None
+        stop.set()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def _cookie_refresh_loop(self, margin, stop):
+        """Update the cookie shortly before it expires until stopped"""
+        while True:
+            delay = self._cookie_refresh_delay(margin)
+            if delay > 0:
+                if stop.wait(delay):
+                    return
+                continue
+            try:
+                with self._auth_lock, self._cookie_store:
+                    # The session may have been renewed while waiting, here
+                    # or by another process sharing the cookie file
+                    self._reload_cookies()
+                    if self._cookie_refresh_delay(margin) <= 0:
+                        self.update_cookie()
+            except Error as ex:
+                LOGGER.warning(f"Failed to refresh cookie ({ex=})")
+                if stop.wait(COOKIE_REFRESH_RETRY):
+                    return
+
     def logout(self):
         """ Log out from the verisure app api """
         try:
@@ -284,31 +767,316 @@ class Session(object):
                 headers={'APPLICATION_ID': 'PS_PYTHON'},
                 cookies=self._cookies)
         finally:
-            self._base_url = None
-            self._giid = None
-            self._cookies = None
-            self._trust_token = None
-            if os.path.exists(self._cookie_file_name):
-                os.remove(self._cookie_file_name)
+            self._clear()
 
     def request(self, *operations):
-        """Request operations"""
+        """Request operations
+
+        An expired session is renewed once, shared by all threads, and the
+        operations are then requested again.
+        """
         if not operations:
             # Return empty json if no operations were requested
-            return json.loads("{}")
-        response = self._post(
+            return self._codec.loads(b"{}")
+        if self._cache is None:
+            return self._coalescing_request(*operations)
+        responses, missing, generations = self._cache.split(operations)
+        if not missing:
+            return self._cache.merge(responses, [])
+        response = self._coalescing_request(*missing)
+        requested = self._cache.update(missing, response, generations)
+        if requested is None:
+            return response
+        return self._cache.merge(responses, requested)
+
+    def on_mutation(self, callback):
+        """ Register a callback, called with the operations of each request
+        with a mutation after it is requested
+        """
+        self._mutation_callbacks.append(callback)
+
+    def _mutated(self, operations):
+        for callback in self._mutation_callbacks:
+            try:
+                callback(operations)
+            except Exception:
+                LOGGER.exception("Mutation callback failed")
+
+    def _coalescing_request(self, *operations):
+        """
+        Request operations, or wait for an identical request in flight. A
+        mutation detaches the reads in flight, so reads after it are sent
+        again instead of sharing an outdated response, and is passed to the
+        `on_mutation` callbacks.
+        """
+        if any(map(is_mutation, operations)):
+            with self._in_flight_lock:
+                self._in_flight.clear()
+            response = self._renewing_request(*operations)
+            self._mutated(operations)
+            return response
+        if not self._coalesce:
+            return self._renewing_request(*operations)
+        key = tuple(map(operation_key, operations))
+        with self._in_flight_lock:
+            future = self._in_flight.get(key)
+            waiting = future is not None
+            if not waiting:
+                future = concurrent.futures.Future()
+                self._in_flight[key] = future
+        if waiting:
+            LOGGER.debug(f"Wait for identical request in flight ({key=})")
+            return future.result()
+        try:
+            future.set_result(self._renewing_request(*operations))
+        except BaseException as ex:
+            future.set_exception(ex)
+        finally:
+            with self._in_flight_lock:
+                if self._in_flight.get(key) is future:
+                    del self._in_flight[key]
+        return future.result()
+
+    def _renewing_request(self, *operations):
+        """Request operations, renew the session if it has expired"""
+        cookies = self._cookies
+        try:
+            return self._request(*operations)
+        except LoginError:
+            if cookies is None:
+                raise
+            LOGGER.info("Request not authorized, renew session")
+            self._reauthenticate(cookies)
+            return self._request(*operations)
+
+    def _request(self, *operations):
+        """Request operations without renewing the session"""
+        post = self._post if self._hedge is None \
+            or any(map(is_mutation, operations)) else self._hedged_post
+        data = self._post_graphql(post, self._operations.encode(
+            operations, persisted=self._persisted_queries))
+        if self._persisted_queries:
+            missing = self._operations.not_persisted(data)
+            if missing:
+                LOGGER.debug(f"Register persisted queries ({missing=})")
+                data = self._operations.replace(
+                    data, missing, self._post_graphql(
+                        post, self._operations.encode(
+                            [operations[index] for index in missing],
+                            register=True)))
+        return data
+
+    def _post_graphql(self, post, body):
+        """Post an encoded request body, return the parsed response"""
+        response, data = post(
             '/graphql',
             headers={
                 'APPLICATION_ID': 'PS_PYTHON',
                 'Accept': 'application/json'},
             cookies=self._cookies,
-            data=json.dumps(list(operations)))
-        return json.loads(response.text)
+            data=body)
+        if data is None:
+            raise ResponseError(response.status_code, response.text)
+        return data
+
+    def _reauthenticate(self, cookies):
+        """
+        Renew the session, unless another thread has already renewed it since
+        a request was sent using `cookies`, or another process has stored a
+        new cookie. Update the cookie, or fall back to login using the cookie
+        file or the password.
+        """
+        with self._auth_lock, self._cookie_store:
+            if self._cookies is not cookies or self._reload_cookies():
+                return
+            try:
+                self.update_cookie()
+                return
+            except Error as ex:
+                LOGGER.info(f"Failed to update cookie ({ex=})")
+            try:
+                self._login_cookie()
+                return
+            except Error as ex:
+                LOGGER.info(f"Failed to login using cookie ({ex=})")
+            self._login()
 
     def get_installations(self):
         """ Get information about installations """
         return self.request(self.fetch_all_installations())
 
+    @staticmethod
+    def _installation_giids(installations):
+        """Get the giid of all installations"""
+        return [
+            installation['giid'] for installation
+            in installations['data']['account']['installations']]
+
+    def request_installations(self, *builders, giids=None,
+                              max_concurrency=8):
+        """ Request operations for several installations concurrently
+
+        Args:
+            builders: operations called with a giid keyword argument,
+                e.g. session.arm_state, session.climate
+            giids (list): installations to request, default is all
+            max_concurrency (int): max number of requests in parallel, keep
+                it below pool_maxsize to reuse connections
+
+        Return a dict with the response, or the raised Error, per giid
+        """
+        if giids is None:
+            giids = self._installation_giids(self.get_installations())
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_concurrency) as executor:
+            futures = {
+                giid: executor.submit(
+                    self.request,
+                    *[builder(giid=giid) for builder in builders])
+                for giid in giids}
+        results = {}
+        for giid, future in futures.items():
+            try:
+                results[giid] = future.result()
+            except Error as ex:
+                LOGGER.warning(f"Request failed ({giid=}, {ex=})")
+                results[giid] = ex
+        return results
+
+    def request_snapshot(self, *operations):
+        """ Request operations on one installation as a single operation
+
+        The installation is resolved once for all operations, e.g.
+        `session.request_snapshot(session.arm_state(), session.climate())`.
+
+        Return a response per operation, like `request` for each operation
+        """
+        snapshot, plan = merge_installation(operations)
+        return split_installation(self.request(snapshot), plan)
+
+    def iter_event_log(self, giid=None, pagesize=50, event_categories=None,
+                       from_date=None, to_date=None, contact_ids=None,
+                       device_labels=None, prefetch=False):
+        """ Iterate over events in the event log, newest first
+
+        Pages are requested when needed, only one page (two when
+        prefetching) is kept in memory.
+
+        Args:
+            giid (str): Installation identifier, default is the set giid
+            pagesize (int): number of events to request at a time
+            event_categories (list): categories, default is all
+            from_date (str): only events after this date
+            to_date (str): only events before this date
+            contact_ids (list): only events from these contacts
+            device_labels (list): only events from these devices
+            prefetch (bool): request the next page while iterating
+        """
+        def page(offset):
+            return self.event_log(
+                giid, offset, pagesize, event_categories,
+                from_date, to_date, contact_ids, device_labels)
+
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) \
+            if prefetch else None
+        try:
+            offset = 0
+            response = self.request(page(offset))
+            while True:
+                event_log = self._event_log_page(response)
+                more = event_log['moreDataAvailable']
+                if more and executor is not None:
+                    next_response = executor.submit(
+                        self.request, page(offset + pagesize))
+                yield from event_log['pagedList']
+                if not more:
+                    return
+                offset += pagesize
+                response = next_response.result() if executor is not None \
+                    else self.request(page(offset))
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+    @staticmethod
+    def _event_log_page(response):
+        """Get the event log page from a response"""
+        if 'errors' in response:
+            raise ResponseError(200, response['errors'])
+        return response['data']['installation']['eventLog']
+
+    def request_and_wait(self, operation, timeout=30, initial_delay=0.5,
+                         max_delay=5, jitter=0.2):
+        """ Request a mutation and wait until the state change completes
+
+        Polls the arm or lock state with exponential backoff.
+
+        Args:
+            operation (dict): arm_away, arm_home, disarm, door_lock or
+                door_unlock operation
+            timeout (float): seconds to wait in total
+            initial_delay (float): seconds to wait before the first poll
+            max_delay (float): max seconds between polls
+            jitter (float): random part of the delays, 0.2 is +-20%
+
+        Return the final poll result, with `result` and `createTime`
+        """
+        deadline = time.monotonic() + timeout
+        poll, field = self._poll_operation(operation, self.request(operation))
+        for delay in backoff_delays(initial_delay, max_delay, jitter=jitter):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise PollTimeoutError(
+                    f"{operation['operationName']} did not complete")
+            time.sleep(min(delay, remaining))
+            result = self._poll_result(self.request(poll), field)
+            if result is not None:
+                return result
+
+    def _poll_operation(self, operation, response):
+        """
+        Get the operation polling the state change of a mutation, and the
+        response field with the poll result
+        """
+        name = operation.get('operationName')
+        if name not in POLLED_MUTATIONS:
+            raise Error(f"Can not wait for {name}")
+        if 'errors' in response:
+            raise ResponseError(200, response['errors'])
+        field, future_state = POLLED_MUTATIONS[name]
+        transaction_id = response['data'][field]
+        variables = operation['variables']
+        if 'deviceLabel' in variables:
+            return self.poll_lock_state(
+                transaction_id, variables['deviceLabel'], future_state,
+                variables['giid']), 'doorLockStateChangePollResult'
+        return self.poll_arm_state(
+            transaction_id, future_state,
+            variables['giid']), 'armStateChangePollResult'
+
+    @staticmethod
+    def _select_fields(operation, root, fields):
+        """Reduce the document of an operation to fields below root"""
+        if fields is not None:
+            operation['query'] = select_fields(
+                operation['query'], root, fields)
+        return operation
+
+    @staticmethod
+    def _poll_result(response, field):
+        """Get the result of a poll, or None if the change is pending"""
+        if 'errors' in response:
+            raise ResponseError(200, response['errors'])
+        result = response['data']['installation'][field]
+        if result['result'] == 'NO_DATA':
+            return None
+        return result
+
+    @property
+    def giid(self):
+        """ Installation giid used by default """
+        return self._giid
+
     def set_giid(self, giid):
         """ Set installation giid
 
@@ -396,15 +1164,18 @@ class Session(object):
 
     @query_func
     def climate(self,
-                giid: VariableTypes.Giid=None):
+                giid: VariableTypes.Giid=None,
+                fields=None):
         """Get climate"""
         assert giid or self._giid, "Set default giid or pass explicit"
-        return {
+        operation = {
             "operationName": "Climate",
             "variables": {
                 "giid": giid or self._giid},
             "query": "query Climate($giid: String!) {\n  installation(giid: $giid) {\n    climates {\n      device {\n        deviceLabel\n        area\n        gui {\n          label\n          __typename\n        }\n        __typename\n      }\n      humidityEnabled\n      humidityTimestamp\n      humidityValue\n      temperatureTimestamp\n      temperatureValue\n      thresholds {\n        aboveMaxAlert\n        belowMinAlert\n        sensorType\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",  # noqa: E501
         }
+        return self._select_fields(
+            operation, 'installation.climates', fields)
 
     @query_func
     def disarm(self,
@@ -505,23 +1276,33 @@ class Session(object):
 
     @query_func
     def event_log(self,
-                  giid: VariableTypes.Giid=None):
+                  giid: VariableTypes.Giid=None,
+                  offset=0,
+                  pagesize=15,
+                  event_categories=None,
+                  from_date=None,
+                  to_date=None,
+                  contact_ids=None,
+                  device_labels=None,
+                  fields=None):
         """Read event log"""
         assert giid or self._giid, "Set default giid or pass explicit"
-        return {
+        operation = {
             "operationName": "EventLog",
             "variables": {
                 "giid": giid or self._giid,
-                "offset": 0,
-                "pagesize": 15,
-                "eventCategories": ["INTRUSION", "FIRE", "SOS", "WATER", "ANIMAL", "TECHNICAL", "WARNING", "ARM", "DISARM", "LOCK", "UNLOCK", "PICTURE", "CLIMATE", "CAMERA_SETTINGS"],  # noqa: E501
-                "eventContactIds": [],
-                "eventDeviceLabels": [],
-                "fromDate": None,
-                "toDate": None
+                "offset": offset,
+                "pagesize": pagesize,
+                "eventCategories": event_categories or EVENT_CATEGORIES,
+                "eventContactIds": contact_ids or [],
+                "eventDeviceLabels": device_labels or [],
+                "fromDate": from_date,
+                "toDate": to_date
             },
             "query": "query EventLog($giid: String!, $offset: Int!, $pagesize: Int!, $eventCategories: [String], $fromDate: String, $toDate: String, $eventContactIds: [String], $eventDeviceLabels: [String]) {\n  installation(giid: $giid) {\n    eventLog(offset: $offset, pagesize: $pagesize, eventCategories: $eventCategories, eventContactIds: $eventContactIds, eventDeviceLabels: $eventDeviceLabels, fromDate: $fromDate, toDate: $toDate) {\n      moreDataAvailable\n      pagedList {\n        device {\n          deviceLabel\n          area\n          gui {\n            label\n            __typename\n          }\n          __typename\n        }\n        arloDevice {\n          name\n          __typename\n        }\n        gatewayArea\n        eventType\n        eventCategory\n        eventSource\n        eventId\n        eventTime\n        userName\n        armState\n        userType\n        climateValue\n        sensorType\n        eventCount\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",  # noqa: E501
         }
+        return self._select_fields(
+            operation, 'installation.eventLog.pagedList', fields)
 
     @query_func
     def fetch_all_installations(self):
@@ -629,15 +1410,18 @@ class Session(object):
 
     @query_func
     def smart_button(self,
-                     giid: VariableTypes.Giid=None):
+                     giid: VariableTypes.Giid=None,
+                     fields=None):
         """Get smart button state"""
         assert giid or self._giid, "Set default giid or pass explicit"
-        return {
+        operation = {
             "operationName": "SmartButton",
             "variables": {
                 "giid": giid or self._giid},
             "query": "query SmartButton($giid: String!) {\n  installation(giid: $giid) {\n    smartButton {\n      entries {\n        smartButtonId\n        icon\n        label\n        color\n        active\n        action {\n          actionType\n          expectedState\n          target {\n            ... on Installation {\n              alias\n              __typename\n            }\n            ... on Device {\n              deviceLabel\n              area\n              gui {\n                label\n                __typename\n              }\n              featureStatuses(type: \"SmartPlug\") {\n                device {\n                  deviceLabel\n                  __typename\n                }\n                ... on SmartPlug {\n                  icon\n                  isHazardous\n                  __typename\n                }\n                __typename\n              }\n              __typename\n            }\n            __typename\n          }\n          __typename\n        }\n        __typename\n      }\n      __typename\n    }\n    __typename\n  }\n}\n",  # noqa: E501
         }
+        return self._select_fields(
+            operation, 'installation.smartButton.entries', fields)
 
     @query_func
     def smart_lock(self,
@@ -733,10 +1517,11 @@ class Session(object):
     def cameras_image_series(self, 
                              limit=50,
                              offset=0,
-                             giid: VariableTypes.Giid=None):
+                             giid: VariableTypes.Giid=None,
+                             fields=None):
         """Get the cameras image series"""
         assert giid or self._giid, "Set default giid or pass explicit"
-        return {
+        operation = {
             "operationName": "GQL_CCCP_SearchMedia",
             "variables": {
                 "giid": giid or self._giid,
@@ -744,6 +1529,8 @@ class Session(object):
                 "offset": offset},
             "query": "mutation GQL_CCCP_SearchMedia(\n	$giid: BigInt!\n	$offset: Int\n	$limit: Int\n	$fromDate: Date\n	$toDate: Date) {\n\n	ContentProviderMediaSearch(\n		giid: $giid\n		offset: $offset\n		limit: $limit\n		fromDate: $fromDate\n		toDate: $toDate\n	) {\n		totalNumberOfMediaSeries\n		mediaSeriesList {\n			seriesId\n			storageType\n			viewed\n			timestamp\n			deviceMediaList {\n				contentUrl\n				mediaAvailable\n				deviceLabel\n				mediaId\n				contentType\n				timestamp\n				requestTimestamp\n				duration\n				expiryDate\n				viewed\n				thumbnailUrl\n				bitRate\n				width\n				height\n				codec\n			}\n		}\n	}\n}",  # noqa: E501}
         }
+        return self._select_fields(
+            operation, 'ContentProviderMediaSearch.mediaSeriesList', fields)
 
     @query_func
     def camera_get_request_id(self,
@@ -775,13 +1562,90 @@ class Session(object):
             "query": "query queryCaptureImageRequestStatus($giid: String!, $deviceLabel: String!, $requestId: BigInt!) {\n  installation(giid: $giid) {\n    cameraContentProvider {\n      captureImageRequestStatus(deviceLabel: $deviceLabel, requestId: $requestId) {\n        mediaRequestStatus\n      }\n    }\n  }\n}",  # noqa: E501
             }
 
-    def download_image(self, image_url, file_name):
-        """Download image from url"""
+    def _get_image(self, image_url, timeout, headers=None):
+        """Request an image, return a reader for the response body"""
         try:
-            response = requests.get(image_url, stream=True)
+            return _ImageReader(self._http.get(
+                image_url, headers=headers, stream=True, timeout=timeout))
         except requests.exceptions.RequestException as ex:
             raise RequestError("Failed to get image") from ex
-        with open(file_name, 'wb') as image_file:
-            for chunk in response.iter_content(chunk_size=1024):
-                if chunk:
-                    image_file.write(chunk)
+
+    @staticmethod
+    def _copy_image(reader, write, buffer_size):
+        """Pass the body to write, in chunks of a reused buffer"""
+        view = memoryview(bytearray(buffer_size))
+        total = 0
+        while True:
+            size = reader.readinto(view)
+            if not size:
+                return total
+            write(view[:size])
+            total += size
+
+    def open_image(self, image_url, timeout=30,
+                   buffer_size=IMAGE_BUFFER_SIZE):
+        """ Open an image url as a binary file-like object
+
+        Read the image without writing it to disk, close the stream to
+        release the connection.
+
+        Args:
+            image_url (str): url to download from
+            timeout (float): seconds to wait for the server to respond
+            buffer_size (int): bytes to buffer
+        """
+        reader = self._get_image(image_url, timeout)
+        if reader.status_code >= 300:
+            reader.close()
+            raise ResponseError(reader.status_code, "Failed to get image")
+        return io.BufferedReader(reader, buffer_size)
+
+    def stream_image(self, image_url, write, timeout=30,
+                     buffer_size=IMAGE_BUFFER_SIZE):
+        """ Stream an image to a callable or a writable object
+
+        The image is passed in chunks, memoryviews of a buffer that is
+        reused, so `write` must copy or consume a chunk before it returns.
+
+        Args:
+            image_url (str): url to download from
+            write: callable, or object with a write method, taking chunks
+            timeout (float): seconds to wait for the server to respond
+            buffer_size (int): max bytes in a chunk
+
+        Return the size of the image
+        """
+        write = getattr(write, 'write', write)
+        with self.open_image(image_url, timeout, buffer_size) as stream:
+            return self._copy_image(stream.raw, write, buffer_size)
+
+    def download_image(self, image_url, file_name, timeout=30,
+                       chunk_size=65536, resume=False):
+        """ Download image from url
+
+        The image is written to `file_name`.part and moved to `file_name`
+        when complete.
+
+        Args:
+            image_url (str): url to download from
+            file_name (str): path to write the image to
+            timeout (float): seconds to wait for the server to respond
+            chunk_size (int): bytes to read and write at a time
+            resume (bool): continue a partial download using a range request
+        """
+        part_file_name = f'{file_name}.part'
+        offset = os.path.getsize(part_file_name) \
+            if resume and os.path.exists(part_file_name) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else None
+        with self._get_image(image_url, timeout, headers) as reader:
+            status_code = reader.status_code
+            if status_code == 416 and offset:
+                # Nothing left to download
+                os.replace(part_file_name, file_name)
+                return
+            if status_code >= 300:
+                raise ResponseError(status_code, "Failed to get image")
+            mode = 'ab' if status_code == 206 else 'wb'
+            with open(part_file_name, mode) as image_file:
+                self._copy_image(reader, image_file.write, chunk_size)
+        os.replace(part_file_name, file_name)
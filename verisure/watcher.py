@@ -0,0 +1,333 @@
+'''
+Watch installations for changes
+'''
+
+import asyncio
+import logging
+import numbers
+import threading
+import time
+
+from .session import Error
+
+LOGGER = logging.getLogger(__package__)
+
+
+class Change(object):
+    """ A changed value in the response to an operation
+
+    Items in lists are identified by their device label when they have one,
+    otherwise by their position.
+
+    Attributes:
+        giid (str): installation identifier
+        operation (str): operationName of the operation
+        path (tuple): keys from the response data to the value
+        old: value before the change, None if it was added
+        new: value after the change, None if it was removed
+    """
+
+    def __init__(self, giid, operation, path, old, new):
+        self.giid = giid
+        self.operation = operation
+        self.path = path
+        self.old = old
+        self.new = new
+
+    @property
+    def field(self):
+        """Name of the changed field"""
+        return self.path[-1] if self.path else None
+
+    def __repr__(self):
+        return (
+            f"Change({self.giid!r}, {self.operation!r}, {self.path!r}, "
+            f"{self.old!r}, {self.new!r})")
+
+
+def _item_key(item):
+    if isinstance(item, dict):
+        device = item.get('device')
+        if isinstance(device, dict) and device.get('deviceLabel'):
+            return device['deviceLabel']
+        return item.get('deviceLabel')
+    return None
+
+
+def _keyed(items):
+    """Items of a list by device label, or by position if they have none"""
+    keys = [_item_key(item) for item in items]
+    if None in keys or len(set(keys)) != len(keys):
+        keys = range(len(items))
+    return dict(zip(keys, items))
+
+
+def diff(old, new, path=()):
+    """ Iterate over (path, old, new) for each changed value """
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in list(new) + [key for key in old if key not in new]:
+            if key != '__typename':
+                yield from diff(old.get(key), new.get(key), path + (key,))
+    elif isinstance(old, list) and isinstance(new, list):
+        old_items = _keyed(old)
+        new_items = _keyed(new)
+        for key in list(new_items) + [
+                key for key in old_items if key not in new_items]:
+            yield from diff(
+                old_items.get(key), new_items.get(key), path + (key,))
+    elif old != new:
+        yield path, old, new
+
+
+def _crosses(old, new, thresholds):
+    """Check if a number moved past any of the thresholds"""
+    if not isinstance(old, numbers.Real) or not isinstance(new, numbers.Real):
+        return True
+    low, high = sorted((old, new))
+    return any(low < threshold <= high for threshold in thresholds)
+
+
+class Watcher(object):
+    """ Poll operations per installation and call callbacks on changes
+
+    Polling is fast after a change, a mutation requested through the
+    session or a call to `wake`, and slows down while nothing changes.
+
+    Args:
+        session (Session): logged in session
+        builders (list): operations called with a giid keyword argument,
+            e.g. session.arm_state, session.door_window
+        giids (list): installations to watch, default is the set giid
+        min_interval (float): seconds between polls after a change
+        max_interval (float): max seconds between polls when quiet
+        slowdown (float): factor to increase the interval by per quiet poll
+
+    """
+
+    def __init__(self, session, builders, giids=None, min_interval=5,
+                 max_interval=120, slowdown=1.5):
+        self._session = session
+        self._builders = list(builders)
+        self._giids = giids
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._slowdown = slowdown
+        self._interval = min_interval
+        self._states = {}
+        self._callbacks = []
+        self._thread = None
+        self._stop = threading.Event()
+        self._wakeup = threading.Event()
+        session.on_mutation(lambda operations: self.wake())
+
+    @property
+    def interval(self):
+        """Seconds until the next poll"""
+        return self._interval
+
+    def on_change(self, callback, fields=None, thresholds=None):
+        """ Register a callback, called with each Change
+
+        Args:
+            callback (callable): called with a Change
+            fields (list): only call for changes of these fields
+            thresholds (dict): per field, the values a number has to move
+                past for the callback to be called, e.g.
+                {'temperatureValue': [5, 25]}
+        """
+        self._callbacks.append((callback, fields, thresholds or {}))
+
+    def wake(self):
+        """Poll at the shortest interval again, e.g. after a mutation"""
+        self._interval = self._min_interval
+        self._wakeup.set()
+
+    def _giid_list(self):
+        return self._giids or [self._session.giid]
+
+    def _operations(self, giid):
+        return [builder(giid=giid) for builder in self._builders]
+
+    def _update(self, giid, operations, response):
+        """ Store the new responses of an installation, return the changes
+        against the previous ones
+        """
+        if isinstance(response, Error):
+            LOGGER.warning(f"Watch failed ({giid=}, {response=})")
+            return []
+        responses = response if isinstance(response, list) else [response]
+        changes = []
+        for operation, result in zip(operations, responses):
+            if 'errors' in result:
+                LOGGER.warning(
+                    f"Watch failed ({giid=}, {operation['operationName']=})")
+                continue
+            key = (giid, operation['operationName'])
+            previous = self._states.get(key)
+            self._states[key] = result['data']
+            if previous is None:
+                continue
+            changes.extend(
+                Change(giid, operation['operationName'], path, old, new)
+                for path, old, new in diff(previous, result['data']))
+        return changes
+
+    def _matches(self, changes):
+        """Iterate over the callbacks to call with each change"""
+        for change in changes:
+            for callback, fields, thresholds in self._callbacks:
+                if fields is not None and change.field not in fields:
+                    continue
+                if change.field in thresholds and not _crosses(
+                        change.old, change.new, thresholds[change.field]):
+                    continue
+                yield callback, change
+
+    def _adapt(self, changes):
+        """Poll fast after changes, slow down while nothing changes"""
+        if changes:
+            self._interval = self._min_interval
+        else:
+            self._interval = min(
+                self._interval * self._slowdown, self._max_interval)
+        LOGGER.debug(f"Watched ({len(changes)=}, {self._interval=})")
+
+    def _notify(self, changes):
+        for callback, change in self._matches(changes):
+            try:
+                callback(change)
+            except Exception:
+                LOGGER.exception(f"Watch callback failed ({change=})")
+        self._adapt(changes)
+
+    def poll(self):
+        """ Poll all installations once and call the callbacks
+
+        The first poll only records the state. Return the changes.
+        """
+        giids = self._giid_list()
+        responses = self._session.request_installations(
+            *self._builders, giids=giids)
+        changes = []
+        for giid in giids:
+            changes.extend(self._update(
+                giid, self._operations(giid), responses[giid]))
+        self._notify(changes)
+        return changes
+
+    def start(self):
+        """ Poll in a background thread until stopped """
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._wakeup.clear()
+        self._thread = threading.Thread(
+            target=self._run, name='verisure-watcher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop polling in the background """
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wakeup.set()
+        if self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            try:
+                self.poll()
+            except Exception:
+                LOGGER.exception("Watch poll failed")
+                self._adapt([])
+            self._wakeup.wait(max(
+                self._interval - (time.monotonic() - started), 0))
+            self._wakeup.clear()
+
+
+class AsyncWatcher(Watcher):
+    """ Poll operations per installation and call callbacks on changes
+
+    Like `Watcher`, for an AsyncSession. Callbacks may be coroutines.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._task = None
+        self._wake = None
+        self._callback_tasks = set()
+
+    def wake(self):
+        """Poll at the shortest interval again, e.g. after a mutation"""
+        super().wake()
+        if self._wake is not None:
+            self._wake.set()
+
+    def _notify(self, changes):
+        for callback, change in self._matches(changes):
+            try:
+                result = callback(change)
+                if asyncio.iscoroutine(result):
+                    task = asyncio.ensure_future(result)
+                    self._callback_tasks.add(task)
+                    task.add_done_callback(self._callback_done)
+            except Exception:
+                LOGGER.exception(f"Watch callback failed ({change=})")
+        self._adapt(changes)
+
+    def _callback_done(self, task):
+        self._callback_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            LOGGER.error("Watch callback failed", exc_info=task.exception())
+
+    async def poll(self):
+        """ Poll all installations once and call the callbacks
+
+        The first poll only records the state. Return the changes.
+        """
+        giids = self._giid_list()
+        responses = await self._session.request_installations(
+            *self._builders, giids=giids)
+        changes = []
+        for giid in giids:
+            changes.extend(self._update(
+                giid, self._operations(giid), responses[giid]))
+        self._notify(changes)
+        return changes
+
+    def start(self):
+        """ Poll in a background task until stopped """
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        """ Stop polling in the background """
+        if self._task is None:
+            return
+        task = self._task
+        self._task = None
+        task.cancel()
+        if task is not asyncio.current_task():
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        self._wake = asyncio.Event()
+        while True:
+            started = time.monotonic()
+            try:
+                await self.poll()
+            except Exception:
+                LOGGER.exception("Watch poll failed")
+                self._adapt([])
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), max(
+                    self._interval - (time.monotonic() - started), 0))
+            except asyncio.TimeoutError:
+                pass